@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+import os, sys, subprocess
+import re
+import json, random
+import tempfile, shutil
+import time, tracemalloc, gc
+from concurrent.futures import ProcessPoolExecutor
+
+import build
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=
+        "Benchmarks for the markdown renderer and the build, run against generated content. "
+        "The numbers are only meaningful compared to a baseline saved on the same machine.")
+    parser.add_argument("--save-baseline", action="store_true", help=
+        "Save the results as the baseline for future runs to compare against.")
+    parser.add_argument("--threshold", metavar="PERCENT", type=float, default=20, help=
+        "How much slower or bigger than the baseline counts as a regression. "
+        "A regression makes the exit status nonzero. Default: %(default)s")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5, help=
+        "Run each benchmark this many times, and report the fastest. Default: %(default)s")
+    parser.add_argument("--scale", type=float, default=1.0, help=
+        "Multiply the size of every generated corpus by this. Default: %(default)s")
+    parser.add_argument("--only", metavar="SUBSTRING", help=
+        "Only run the benchmarks with this in their name.")
+    args = parser.parse_args()
+
+    assert os.path.samefile(".", build.get_repo_root()), "must be executed from the repo root"
+
+    if args.only == None or args.only in linear_time_check_name:
+        check_linear_time(build.get_markdown_looks_good(), int(2**20 * args.scale))
+
+    results = {}
+    for name, setup, run in generate_benchmarks(args.scale):
+        if args.only != None and args.only not in name: continue
+        results[name] = measure(setup, run, args.repeat)
+        print_result(name, results[name], load_baseline().get(name), args.threshold)
+
+    if args.save_baseline:
+        baseline = load_baseline()
+        baseline.update(results)
+        save_baseline(baseline)
+        return
+    baseline = load_baseline()
+    regressions = [name for name, result in results.items() if is_regression(result, baseline.get(name), args.threshold)]
+    if regressions:
+        sys.exit("ERROR: regressed past {}%: {}".format(args.threshold, ", ".join(regressions)))
+
+# Each benchmark is (name, setup, run). setup() is called before every run(), and isn't counted.
+# The end-to-end benchmarks change the working directory to a generated site while they run.
+def generate_benchmarks(scale):
+    markdown_looks_good = build.get_markdown_looks_good()
+    rng = random.Random(1337)
+    corpora = {
+        "long document": generate_long_document(rng, int(8000 * scale)),
+        "many anchors": generate_anchor_document(rng, int(2000 * scale)),
+        "code heavy": generate_code_document(rng, int(2000 * scale)),
+        # Its own rng so the other corpora stay the same as in older baselines.
+        "code heavy highlighted": generate_code_document(random.Random(1337), int(2000 * scale), language="c"),
+    }
+    for corpus_name, contents in corpora.items():
+        yield "markdown_to_html " + corpus_name, None, (
+            lambda contents=contents: markdown_looks_good.markdown_to_html(contents, do_internal_links=True, toc_levels=3)
+        )
+
+    pages = generate_anchor_pages(rng, int(2000 * scale), 20)
+    yield "markdown_to_html_batch 20 pages", None, (
+        lambda: markdown_looks_good.markdown_to_html_batch(pages, do_internal_links=True, toc_levels=3)
+    )
+    def render_pages_in_parallel():
+        with ProcessPoolExecutor() as executor:
+            markdown_looks_good.markdown_to_html_batch(pages, do_internal_links=True, toc_levels=3, executor=executor)
+    yield "markdown_to_html_batch 20 pages in parallel", None, render_pages_in_parallel
+
+    lines = corpora["long document"].split("\n") + corpora["code heavy"].split("\n")
+    check_escaping(markdown_looks_good, lines + generate_escaping_samples(rng, 100000))
+    yield "escape_text", None, lambda: [markdown_looks_good.escape_text(line) for line in lines]
+    yield "escape_text regex version", None, lambda: [regex_escape_text(line) for line in lines]
+    yield "escape_texts", None, lambda: markdown_looks_good.escape_texts(lines)
+    yield "escape_attribute", None, lambda: [markdown_looks_good.escape_attribute(line) for line in lines]
+    yield "escape_attribute regex version", None, lambda: [regex_escape_attribute(line) for line in lines]
+    headings = [line.lstrip("# ") for line in corpora["many anchors"].split("\n") if line.startswith("#")]
+    yield "format_slug", None, lambda: [markdown_looks_good.format_slug(heading) for heading in headings]
+
+    yield from generate_build_benchmarks(rng, posts=int(1000 * scale), commits=int(3000 * scale))
+
+def generate_build_benchmarks(rng, *, posts, commits):
+    repo_root = os.getcwd()
+    fixture = tempfile.mkdtemp(prefix="bench-site-")
+    try:
+        make_site_fixture(fixture, rng, posts=posts, commits=commits)
+        os.chdir(fixture)
+        manifest = {}
+
+        def start_cold():
+            shutil.rmtree(".build-cache", ignore_errors=True)
+            clear_caches()
+            manifest.clear()
+        def build_html():
+            build.build_html(manifest)
+        yield "load_git_history cold", start_cold, build.load_git_history
+        yield "build_html cold", start_cold, build_html
+
+        def start_warm():
+            clear_caches()
+            if not manifest:
+                build.build_html(manifest)
+        yield "build_html nothing changed", start_warm, build_html
+
+        post_paths = sorted(path for path in os.listdir("blog") if path.endswith(".md"))
+        def change_one_post():
+            start_warm()
+            with open(os.path.join("blog", rng.choice(post_paths)), "a") as f:
+                f.write("\n" + generate_paragraph(rng) + "\n")
+        yield "build_html one post changed", change_one_post, build_html
+    finally:
+        os.chdir(repo_root)
+        shutil.rmtree(fixture)
+
+# The escaping functions used to be these. They're here to compare the speed against,
+# and to make sure the faster versions give exactly the same output.
+regex_attribute_substitutions = {
+    '"': "&quot;",
+    "'": "&apos;",
+    "=": "&#61;",
+    ">": "&gt;",
+    "<": "&lt;",
+    "`": "&#96;",
+    "&": "&amp;",
+}
+regex_attribute_escape_re = re.compile(r'[{}]'.format(r''.join(regex_attribute_substitutions.keys())))
+def regex_escape_attribute(text):
+    return regex_attribute_escape_re.sub((lambda m: regex_attribute_substitutions[m.group()]), text)
+regex_text_substitutions = {
+    ">": "&gt;",
+    "<": "&lt;",
+    "&": "&amp;",
+}
+regex_text_escape_re = re.compile(r'[{}]'.format(r''.join(regex_text_substitutions.keys())))
+def regex_escape_text(text):
+    return regex_text_escape_re.sub((lambda m: regex_text_substitutions[m.group()]), text)
+
+def check_escaping(markdown_looks_good, samples):
+    for sample in samples:
+        assert markdown_looks_good.escape_text(sample) == regex_escape_text(sample), repr(sample)
+        assert markdown_looks_good.escape_attribute(sample) == regex_escape_attribute(sample), repr(sample)
+    assert markdown_looks_good.escape_texts(samples) == [regex_escape_text(sample) for sample in samples]
+
+linear_time_check_name = "markdown_to_html linear time check"
+def check_linear_time(markdown_looks_good, size):
+    # Four times the size should take about four times as long.
+    # Re-slicing the rest of the line after each inline token took about ten times as long.
+    def fastest_seconds(contents):
+        seconds = []
+        for _ in range(3):
+            start = time.perf_counter()
+            markdown_looks_good.markdown_to_html(contents, do_internal_links=True, toc_levels=3)
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+    # Not the shared rng, which would change the corpora that saved baselines were measured with.
+    ratio = fastest_seconds(generate_single_paragraph(random.Random(1337), size)) / fastest_seconds(generate_single_paragraph(random.Random(1337), size // 4))
+    assert ratio < 7, "rendering a {} byte paragraph took {:.1f}x as long as a quarter of one".format(size, ratio)
+
+def clear_caches():
+    build.load_git_history_at.cache_clear()
+    build.compile_template.cache_clear()
+
+def measure(setup, run, repeat):
+    # The fastest of several runs is the least noisy.
+    # Memory is measured in one more run, because tracemalloc slows everything down.
+    # Only this process is counted, not the workers that build_html() uses for compiling lots of posts.
+    seconds = None
+    for i in range(repeat + 1):
+        if setup != None:
+            setup()
+        gc.collect()
+        if i < repeat:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds == None else min(seconds, elapsed)
+        else:
+            tracemalloc.start()
+            run()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak_bytes}
+
+def print_result(name, result, baseline_result, threshold):
+    def compare(key):
+        if baseline_result == None: return ""
+        change = (result[key] / baseline_result[key] - 1) * 100
+        return "{:+.0f}%{}".format(change, " REGRESSION" if change > threshold else "")
+    print("{:<44} {:>9.4f}s {:<16} {:>9.1f}MB {}".format(
+        name,
+        result["seconds"], compare("seconds"),
+        result["peak_bytes"] / 1e6, compare("peak_bytes"),
+    ))
+    sys.stdout.flush()
+
+def is_regression(result, baseline_result, threshold):
+    if baseline_result == None: return False
+    return any(result[key] > baseline_result[key] * (1 + threshold / 100) for key in ("seconds", "peak_bytes"))
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".build-cache/bench-baseline.json")
+def load_baseline():
+    try:
+        with open(baseline_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+def save_baseline(baseline):
+    os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+    with open(baseline_path, "w") as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+
+# Synthetic content.
+# Everything has to be valid for the renderer: unique anchors, one blank line after headings, etc.
+
+words = (
+    "the of and to in is that for it as with was on be by this are from at or an have not but which "
+    "build render markdown anchor heading table contents feed index archive history commit blob tree "
+    "zip file version control package manager compiler parser token stream buffer cache hash"
+).split()
+def generate_sentence(rng):
+    sentence = " ".join(rng.choice(words) for _ in range(rng.randint(5, 15)))
+    return sentence[0].upper() + sentence[1:] + "."
+def generate_paragraph(rng):
+    return "\n".join(
+        " ".join(generate_sentence(rng) for _ in range(rng.randint(1, 3)))
+        for _ in range(rng.randint(1, 4))
+    )
+def generate_single_paragraph(rng, size):
+    # All on one line, and dense with inline syntax: `code`, bold terms (which are anchors),
+    # and mentions of them (which are internal links). Each one used to copy the rest of the line.
+    pieces = ["# One Paragraph\n\n"]
+    terms = []
+    length = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.5:
+            piece = "`{}`".format(rng.choice(words))
+        elif roll < 0.55:
+            terms.append("{}{}".format(rng.choice(words), len(terms)))
+            piece = "**{}**".format(terms[-1])
+        elif roll < 0.75 and terms:
+            piece = rng.choice(terms)
+        else:
+            piece = rng.choice(words)
+        pieces.append(piece)
+        length += len(piece) + 1
+    return pieces[0] + " ".join(pieces[1:]) + "\n"
+def generate_code(rng, language=""):
+    lines = []
+    for _ in range(rng.randint(3, 30)):
+        a, b = rng.choice(words), rng.choice(words)
+        lines.append(rng.choice([
+            "if ({a} < {b} && {b} > 0) {{",
+            "    {a} = \"<{b}>\" + '&{a};';",
+            "}}",
+            "for (int i = 0; i < {a}.length; i++) {a}[i] = {b};",
+            "// {a} {b}",
+        ]).format(a=a, b=b))
+    return "```" + language + "\n" + "\n".join(lines) + "\n```"
+
+def generate_escaping_samples(rng, count):
+    # Short strings that are mostly the characters that get escaped, and things that look like escapes.
+    alphabet = list("\"'=<>`&;#") + ["&amp;", "&lt;", "]]>", "a", " ", "\n", "\u00e9", "\U0001f389"]
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))) for _ in range(count)]
+
+def generate_long_document(rng, paragraphs):
+    blocks = ["# Long Document"]
+    for i in range(paragraphs):
+        if i % 50 == 0:
+            blocks.append("### Part {}".format(i // 50))
+        blocks.append(generate_paragraph(rng))
+    return "\n\n".join(blocks) + "\n"
+
+def generate_anchor_document(rng, anchors):
+    # Every heading and bold term is an anchor, and mentions of them elsewhere become internal links.
+    blocks = ["# Many Anchors"]
+    for i in range(anchors):
+        blocks.append("### Heading {}".format(i))
+        blocks.append("This defines **Term {}** and refers to Heading {} and Term {}. {}".format(
+            i, rng.randrange(anchors), rng.randrange(anchors), generate_sentence(rng),
+        ))
+    return "\n\n".join(blocks) + "\n"
+
+def generate_anchor_pages(rng, anchors, page_count):
+    # Like generate_anchor_document() split into pages, with links between the pages.
+    pages = []
+    for page in range(page_count):
+        blocks = ["# Page {}".format(page)]
+        for i in range(page * anchors // page_count, (page + 1) * anchors // page_count):
+            blocks.append("### Heading {}".format(i))
+            blocks.append("This defines **Term {}** and refers to Heading {} and Term {}. {}".format(
+                i, rng.randrange(anchors), rng.randrange(anchors), generate_sentence(rng),
+            ))
+        pages.append(("page-{}.html".format(page), "\n\n".join(blocks) + "\n"))
+    return pages
+
+def generate_code_document(rng, code_blocks, language=""):
+    blocks = ["# Code Heavy"]
+    for i in range(code_blocks):
+        blocks.append("Example `{}` does this: {}".format(rng.choice(words), generate_sentence(rng)))
+        blocks.append(generate_code(rng, language))
+    return "\n\n".join(blocks) + "\n"
+
+def generate_post(rng, number):
+    blocks = ["# Post {}: {}".format(number, generate_sentence(rng).rstrip("."))]
+    for section in range(rng.randint(1, 5)):
+        blocks.append("### Section {}".format(section))
+        for _ in range(rng.randint(1, 5)):
+            blocks.append(rng.choice([generate_paragraph, generate_paragraph, generate_paragraph, generate_code])(rng))
+    return "\n\n".join(blocks) + "\n"
+
+def make_site_fixture(directory, rng, *, posts, commits):
+    # A git repo with the pages build_html() needs,
+    # and a history where the posts are added and then edited over lots of commits.
+    # Using fast-import instead of running git commit thousands of times.
+    site_files = build.find_html_sources() + ["blog/rss-template.xml", "blog/rss.xml"]
+    subprocess.run(["git", "init", "-q", "-b", "master", directory], check=True)
+
+    stream = []
+    def add_data(data):
+        data = data.encode("utf8")
+        stream.append("data {}\n".format(len(data)).encode("utf8"))
+        stream.append(data + b"\n")
+    timestamp = 1420070400 # 2015-01-01
+    post_contents = []
+    for commit_number in range(max(posts, commits) + 1):
+        timestamp += rng.randint(3600, 3 * 86400)
+        stream.append("commit refs/heads/master\nmark :{}\n".format(commit_number + 1).encode("utf8"))
+        stream.append("committer Bench <bench@example.com> {} +0000\n".format(timestamp).encode("utf8"))
+        add_data("commit {}".format(commit_number))
+        if commit_number == 0:
+            for path in site_files:
+                with open(path) as f:
+                    stream.append("M 100644 inline {}\n".format(path).encode("utf8"))
+                    add_data(f.read())
+            continue
+        stream.append("from :{}\n".format(commit_number).encode("utf8"))
+        if len(post_contents) < posts:
+            post_contents.append(generate_post(rng, len(post_contents)))
+            index = len(post_contents) - 1
+        else:
+            index = rng.randrange(posts)
+            post_contents[index] += "\n" + generate_paragraph(rng) + "\n"
+        stream.append("M 100644 inline blog/post-{:05}.md\n".format(index).encode("utf8"))
+        add_data(post_contents[index])
+
+    subprocess.run(["git", "-C", directory, "fast-import", "--quiet"], input=b"".join(stream), check=True)
+    subprocess.run(["git", "-C", directory, "reset", "-q", "--hard"], check=True)
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,16 @@
 import os, sys, subprocess
 import re
 import datetime, email.utils
+import glob, json, hashlib
+import itertools
+import time, traceback
+import shutil
+import gzip, mimetypes
+import struct
+import contextlib, threading
 
-from functools import lru_cache
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 def main():
     import argparse
@@ -13,25 +21,145 @@ def main():
     group.add_argument("--just-build", action="store_true", help=
         "Don't touch s3cmd or the network. Just do the build locally.")
     group.add_argument("--publish", action="store_true", help=
-        "Actually publish instead of just showing a diff. Removes the --dry-run argument from s3cmd sync.")
+        "Actually publish instead of just showing a diff of what would be uploaded.")
+    group.add_argument("--watch", action="store_true", help=
+        "Build, then keep running and rebuild whatever is affected when a source file changes. "
+        "Doesn't touch s3cmd or the network.")
+    parser.add_argument("--serve", metavar="PORT", type=int, nargs="?", const=8000, help=
+        "Implies --watch. Also serve the repo root at http://localhost:PORT/ . Default: %(const)s")
+    parser.add_argument("--force", action="store_true", help=
+        "Regenerate every output even if the build manifest says it's up to date.")
+    parser.add_argument("--publish-to", metavar="DESTINATION", default=default_publish_destination, help=
+        "An s3:// url, which is published to with s3cmd, or a local directory, which is useful for testing. "
+        "Default: %(default)s")
+    parser.add_argument("--external-css", action="store_true", help=
+        "In the published html, replace the inline \"style\" definition with a link to a stylesheet, "
+        "which is published once under a content-hashed name. The html in the repo is unaffected.")
+    parser.add_argument("--publish-encoding", choices=["gzip", "br", "identity"], default="gzip", help=
+        "Publish text files precompressed with this Content-Encoding. "
+        "The bucket can't negotiate encodings, so every client gets this one. "
+        "br requires the brotli python module. Default: %(default)s")
+    parser.add_argument("--publish-jobs", metavar="N", type=int, default=8, help=
+        "How many uploads to do at once. Default: %(default)s")
+    parser.add_argument("--profile", metavar="TRACE", nargs="?", const=default_profile_trace_path, help=
+        "Print how long each phase took, and write a trace that can be opened in https://ui.perfetto.dev/ "
+        "or chrome://tracing to TRACE. Default: %(const)s")
     args = parser.parse_args()
+    if args.serve != None:
+        if args.publish:
+            parser.error("--serve is not allowed with --publish")
+        args.watch = True
+    if args.profile != None and args.watch:
+        parser.error("--profile is not allowed with --watch")
+    if args.publish_encoding == "br" and not has_brotli():
+        parser.error("--publish-encoding=br requires the brotli python module")
 
     assert os.path.samefile(".", get_repo_root()), "must be executed from the repo root"
+    repo_root = os.path.realpath(".")
+    if not args.publish_to.startswith("s3://") and os.path.commonpath([repo_root, os.path.realpath(args.publish_to)]) == repo_root:
+        # Its html would look like more source files to the next build.
+        parser.error("--publish-to must be outside the repo")
 
-    build_html()
-    check_resume()
+    if args.profile != None:
+        global profiler
+        profiler = Profiler()
+    try:
+        build_and_publish(args)
+    finally:
+        if profiler != None:
+            profiler.print_summary()
+            profiler.save_trace(args.profile)
+
+def build_and_publish(args):
+    with profile_span("load_build_manifest"):
+        manifest = load_build_manifest()
+    if args.watch:
+        return watch(manifest, force=args.force, serve_port=args.serve)
+    try:
+        with profile_span("build_html"):
+            build_html(manifest, force=args.force)
+        with profile_span("check_resume"):
+            check_resume(manifest)
+    finally:
+        with profile_span("save_build_manifest"):
+            save_build_manifest(manifest)
 
     if args.just_build: return
-    do_publish(dry_run=not args.publish)
+    with profile_span("stage_publish_objects"):
+        publish_objects = stage_publish_objects(external_css=args.external_css, encoding=args.publish_encoding)
+    with profile_span("do_publish"):
+        do_publish(publish_objects, args.publish_to, dry_run=not args.publish, jobs=args.publish_jobs)
+
+def watch(manifest, *, force, serve_port):
+    # Everything stays warm in this process between builds: the renderer module, compiled templates, and the git history.
+    # The build manifest makes each rebuild only touch what's affected by the change.
+    if serve_port != None:
+        import http.server
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", serve_port), http.server.SimpleHTTPRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("serving at http://localhost:{}/".format(serve_port))
 
-def check_resume():
-    source_mtime = os.stat("resume/index.html").st_mtime
+    def rebuild(force=False):
+        start = time.perf_counter()
+        try:
+            build_html(manifest, force=force)
+        except (Exception, SystemExit):
+            # Keep watching. Hopefully the next save fixes it.
+            traceback.print_exc()
+        else:
+            print("built in {:.0f}ms".format((time.perf_counter() - start) * 1000))
+        save_build_manifest(manifest)
+
+    rebuild(force=force)
+    snapshot = snapshot_sources()
+    print("watching for changes. ^C to stop.")
     try:
-        generated_mtime = os.stat("resume/Josh_Wolfe_resume.pdf").st_mtime
-    except FileNotFoundError:
-        generated_mtime = float("-inf")
-    if source_mtime > generated_mtime:
+        while True:
+            time.sleep(0.05)
+            new_snapshot = snapshot_sources()
+            if new_snapshot == snapshot: continue
+            changed_paths = sorted(path for path in snapshot.keys() | new_snapshot.keys() if snapshot.get(path) != new_snapshot.get(path))
+            print("changed: " + " ".join(changed_paths))
+            if __file__ in changed_paths:
+                # Too much could have changed. Start over.
+                print("restarting")
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            if markdown_looks_good_path in changed_paths:
+                get_markdown_looks_good.cache_clear()
+                get_renderer_version.cache_clear()
+                get_syntax_highlighter_version.cache_clear()
+            rebuild()
+            # Don't count our own writes (e.g. index.html is both an input and an output) as changes.
+            snapshot = snapshot_sources()
+    except KeyboardInterrupt:
+        pass
+
+def snapshot_sources():
+    paths = [
+        __file__,
+        markdown_looks_good_path,
+        "blog/rss-template.xml",
+    ] + find_html_sources() + glob.glob("blog/*.md")
+    snapshot = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def check_resume(manifest):
+    # The pdf is rendered by hand, so we can't regenerate it.
+    # Instead, remember which version of the source the pdf was last seen with,
+    # and complain if the source changed since then but the pdf didn't.
+    pdf_path = "resume/Josh_Wolfe_resume.pdf"
+    source_hash = hash_file("resume/index.html")
+    pdf_hash = hash_file(pdf_path)
+    entry = manifest.get(pdf_path)
+    if pdf_hash == None or (entry != None and entry["inputs"] != source_hash and entry["output"] == pdf_hash):
         sys.exit("ERROR: it looks like resume/Josh_Wolfe_resume.pdf needs to be re-rendered (from a browser).")
+    manifest[pdf_path] = {"inputs": source_hash, "output": pdf_hash}
 
 publish_roots = [
     "index.html",
@@ -39,88 +167,817 @@ publish_roots = [
     "blog/",
     "site/",
 ]
-def do_publish(dry_run):
-    s3cmd = [
-        "s3cmd", "sync",
-        "--acl-public", "--no-preserve",
-        "--add-header=Cache-Control: max-age=0, must-revalidate",
-        # mime magic is buggy for css files. guess mime type based on file extension only.
-        # See https://stackoverflow.com/questions/53708938/s3cmd-flagging-css-with-wrong-mime-type
-        "--no-mime-magic", "--guess-mime-type",
-    ]
+default_publish_destination = "s3://wolfesoftware.com/"
+publish_state_path = ".build-cache/published.json"
+# publish_objects is from stage_publish_objects().
+def do_publish(publish_objects, destination, *, dry_run, jobs):
+    # Rather than asking the bucket what's changed, which scales with the size of the bucket,
+    # remember what we published last time and only upload what's different.
+    backend = get_publish_backend(destination)
+    try:
+        with open(publish_state_path) as f:
+            publish_state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        publish_state = {}
+    # {key: {"hash": "<sha256>", "headers": {...}}}
+    published = publish_state.get(destination)
+
+    local_objects = {}
+    for key, (path, headers) in publish_objects.items():
+        local_objects[key] = {"hash": hash_file(path), "headers": headers}
+
+    if published == None:
+        # Never published to this destination from here. Don't upload what's already there.
+        print("no local record of publishing to {}. comparing against the remote listing.".format(destination))
+        remote_md5s = backend.list_md5s()
+        published = {}
+        for key, local_object in local_objects.items():
+            if remote_md5s.get(key) == hash_file(publish_objects[key][0], "md5"):
+                published[key] = local_object
+        # Even for a dry run, so the next run doesn't have to list the bucket again.
+        publish_state[destination] = published
+        save_publish_state(publish_state)
+
+    changed_keys = sorted(key for key, local_object in local_objects.items() if published.get(key) != local_object)
+    for key in changed_keys:
+        print("upload: {} -> {}{}".format(publish_objects[key][0], destination, key))
+    print("{} to upload, {} unchanged.".format(len(changed_keys), len(local_objects) - len(changed_keys)))
     if dry_run:
-        s3cmd.append("--dry-run")
-    bucket = "s3://wolfesoftware.com/"
+        if changed_keys:
+            print("(dry run. give --publish to actually do it.)")
+        return
+
+    if not changed_keys: return
+    def upload_and_verify(key):
+        path = publish_objects[key][0]
+        backend.upload(key, path, local_objects[key]["headers"])
+        # Make sure the destination got what we uploaded.
+        return backend.get_md5(key) == hash_file(path, "md5")
+    bad_keys = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(upload_and_verify, key): key for key in changed_keys}
+            for future in as_completed(futures):
+                key = futures[future]
+                if future.result():
+                    published[key] = local_objects[key]
+                else:
+                    # Forget about this one, so the next publish tries again.
+                    published.pop(key, None)
+                    bad_keys.append(key)
+    finally:
+        # Remember whatever made it, even if something failed.
+        save_publish_state(publish_state)
+
+    if bad_keys:
+        sys.exit("\n".join("ERROR: published object does not match: " + destination + key for key in sorted(bad_keys)))
+    print("verified {} uploads.".format(len(changed_keys)))
 
+def save_publish_state(publish_state):
+    os.makedirs(os.path.dirname(publish_state_path), exist_ok=True)
+    with open(publish_state_path, "w") as f:
+        json.dump(publish_state, f, indent=1, sort_keys=True)
+
+def list_publishable_files():
     for root in publish_roots:
-        cmd = s3cmd + [root, bucket + root]
-        subprocess.run(cmd, check=True)
+        if not root.endswith("/"):
+            yield root
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
+
+# Everything under these gets published a second time under a name with a hash of its contents,
+# and html references to it are rewritten to that name.
+fingerprinted_roots = [
+    "site/",
+]
+publish_staging_dir = ".build-cache/publish"
+def stage_publish_objects(*, external_css=False, encoding="identity"):
+    # Returns {key: (path, headers)} for everything that should be published,
+    # where key is the name in the bucket and path is the local file with the contents.
+    keys = list(list_publishable_files())
+    publish_objects = {}
+
+    if external_css:
+        stylesheet_path = os.path.join(publish_staging_dir, stylesheet_key)
+        write_file_if_changed(stylesheet_path, get_stylesheet())
+        fingerprinted_stylesheet_key = fingerprint_key(stylesheet_key, stylesheet_path)
+        publish_objects[fingerprinted_stylesheet_key] = (stylesheet_path, get_publish_headers(fingerprinted_stylesheet_key, immutable=True))
+
+    fingerprinted_keys = {}
+    for key in keys:
+        if not any(key.startswith(root) for root in fingerprinted_roots): continue
+        fingerprinted_keys[key] = fingerprint_key(key, key)
+
+    for key in keys:
+        # The original names stay available for anything that links to them from outside.
+        publish_objects[key] = (key, get_publish_headers(key))
+    for key, fingerprinted_key in fingerprinted_keys.items():
+        # The contents at a fingerprinted name can never change.
+        publish_objects[fingerprinted_key] = (key, get_publish_headers(fingerprinted_key, immutable=True))
+
+    # Published html points to the fingerprinted names, but the html in the repo stays as it is.
+    for key in keys:
+        if not key.endswith(".html"): continue
+        with open(key) as f:
+            contents = f.read()
+        new_contents, image_variants = rewrite_img_tags(key, contents, fingerprinted_keys)
+        for variant_key, variant_path in image_variants.items():
+            publish_objects[variant_key] = (variant_path, get_publish_headers(variant_key, immutable=True))
+        new_contents = rewrite_asset_references(key, new_contents, fingerprinted_keys)
+        if external_css:
+            new_contents = link_stylesheet(new_contents, "/" + fingerprinted_stylesheet_key)
+        if new_contents == contents: continue
+        staged_path = os.path.join(publish_staging_dir, key)
+        write_file_if_changed(staged_path, new_contents)
+        publish_objects[key] = (staged_path, get_publish_headers(key))
+
+    for key, (path, headers) in publish_objects.items():
+        if encoding == "identity": break
+        if os.path.splitext(key)[1] not in compressible_extensions: continue
+        compressed_paths = precompress(path)
+        publish_objects[key] = (compressed_paths[encoding], dict(headers, **{
+            # The local file name doesn't say what the content is anymore.
+            "Content-Type": guess_content_type(key),
+            "Content-Encoding": encoding,
+        }))
+
+    return publish_objects
+
+compressible_extensions = {".html", ".xml", ".css", ".js", ".md", ".txt", ".svg", ".json"}
+compressed_cache_dir = ".build-cache/compressed"
+def precompress(path):
+    # Returns {encoding: path} of compressed copies of the file at the highest compression level.
+    # They're cached by the hash of the contents, so unchanged files don't get compressed again.
+    content_hash = hash_file(path)
+    compressed_paths = {}
+    compressors = {"gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if has_brotli():
+        import brotli
+        compressors["br"] = lambda data: brotli.compress(data, quality=11)
+    data = None
+    for encoding, compress in compressors.items():
+        compressed_path = os.path.join(compressed_cache_dir, "{}.{}".format(content_hash, encoding))
+        if not os.path.exists(compressed_path):
+            if data == None:
+                with open(path, "rb") as f:
+                    data = f.read()
+            os.makedirs(compressed_cache_dir, exist_ok=True)
+            with open(compressed_path + ".tmp", "wb") as f:
+                f.write(compress(data))
+            os.replace(compressed_path + ".tmp", compressed_path)
+        compressed_paths[encoding] = compressed_path
+    return compressed_paths
+
+@lru_cache()
+def has_brotli():
+    try:
+        import brotli
+    except ImportError:
+        return False
+    return True
+
+def guess_content_type(key):
+    content_type, _ = mimetypes.guess_type(key)
+    if content_type == None:
+        return "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json", "application/xml", "image/svg+xml"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+def fingerprint_key(key, path):
+    # "site/cards.png" -> "site/cards.cc71cd1ffc.png"
+    stem, extension = os.path.splitext(key)
+    return "{}.{}{}".format(stem, hash_file(path)[:10], extension)
 
-def build_html():
-    definitions = load_authoritative_definitions("index.html")
-    propagate_definitions(definitions, "blog/base.html")
-    definitions["post-list"] = generate_post_list()
+def resolve_url(html_key, url):
+    # Returns the key that a url in the html at html_key refers to, or None if it's not on this site.
+    if url.startswith("/"):
+        return url[1:]
+    if ":" in url or url.startswith("#"):
+        # Some other site, or data:, or mailto:, or something.
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(html_key), url))
 
-    propagate_definitions(definitions, "blog/index.html")
-    propagate_definitions(definitions, "resume/index.html")
-    propagate_definitions(definitions, "index.html")
+asset_reference_re = re.compile(r'(?P<prefix>\b(?:src|href)=["\']?)(?P<url>[^"\'\s>]+)')
+def rewrite_asset_references(html_key, contents, fingerprinted_keys):
+    def replace(match):
+        url = match.group("url")
+        key = resolve_url(html_key, url)
+        fingerprinted_key = fingerprinted_keys.get(key)
+        if fingerprinted_key == None:
+            return match.group()
+        # Only the file name changes, so a relative url stays relative.
+        return match.group("prefix") + url.removesuffix(os.path.basename(key)) + os.path.basename(fingerprinted_key)
+    return asset_reference_re.sub(replace, contents)
 
-def load_authoritative_definitions(path):
-    with open(path) as f:
-        contents = f.read()
+# img.thumbnail is this wide in the "style" definition.
+# The variants are for 1x and 2x screens.
+image_display_width = 200
+image_variant_widths = [200, 400]
+# Images after this many on a page are assumed to be below the fold.
+eager_image_count = 2
+img_tag_re = re.compile(r'<img\b[^>]*>')
+html_attribute_re = re.compile(r'([\w-]+)(?:=("[^"]*"|\'[^\']*\'|[^\s>]+))?')
+def rewrite_img_tags(html_key, contents, fingerprinted_keys):
+    # Returns (new_contents, {variant_key: path}).
+    # Each <img> of a png gets its intrinsic width and height so the layout doesn't shift while it loads,
+    # and loading=lazy if it's below the fold.
+    # If the local toolchain can make resized or more modern variants of the image,
+    # the <img> is wrapped in a <picture> that offers them.
+    image_variants = {}
+    image_count = 0
+    def replace(match):
+        nonlocal image_count
+        image_count += 1
+        tag = match.group()
+        attributes = {name: value for name, value in html_attribute_re.findall(tag[len("<img"):-1])}
+        src = attributes.get("src", "").strip("\"'")
+        key = resolve_url(html_key, src)
+        if key == None or key not in fingerprinted_keys: return tag
+        size = get_png_size(key)
+        if size == None: return tag
 
+        new_attributes = []
+        if "width" not in attributes and "height" not in attributes:
+            new_attributes.append('width="{}" height="{}"'.format(*size))
+        if "loading" not in attributes and image_count > eager_image_count:
+            new_attributes.append('loading="lazy"')
+
+        sources = []
+        # Variants are next to the original, so their urls are the same as src other than the file name.
+        url_prefix = src.removesuffix(os.path.basename(key))
+        stem = os.path.splitext(key)[0]
+        for content_type, variants in make_image_variants(key, size[0]).items():
+            srcset = []
+            for width, path in variants:
+                variant_key = fingerprint_key("{}.{}w{}".format(stem, width, os.path.splitext(path)[1]), path)
+                image_variants[variant_key] = path
+                srcset.append("{}{} {}w".format(url_prefix, os.path.basename(variant_key), width))
+            if content_type == "image/png":
+                new_attributes.append('srcset="{}" sizes="{}px"'.format(", ".join(srcset), image_display_width))
+            else:
+                sources.append('<source type="{}" srcset="{}" sizes="{}px">'.format(content_type, ", ".join(srcset), image_display_width))
+
+        new_tag = tag[:-1].rstrip("/ ") + "".join(" " + attribute for attribute in new_attributes) + ">"
+        if sources:
+            new_tag = "<picture>" + "".join(sources) + new_tag + "</picture>"
+        return new_tag
+    return img_tag_re.sub(replace, contents), image_variants
+
+def get_png_size(path):
+    # Returns (width, height), or None if it's not a png.
+    with open(path, "rb") as f:
+        header = f.read(24)
+    if header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+image_cache_dir = ".build-cache/images"
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/webp", ".webp")
+def make_image_variants(path, original_width):
+    # Returns {content_type: [(width, path), ...]} for whatever variants the available tools can make.
+    # These are cached by the hash of the source image.
+    tools = find_image_tools()
+    widths = sorted({min(width, original_width) for width in image_variant_widths})
+    source_hash = hash_file(path)
+    os.makedirs(image_cache_dir, exist_ok=True)
+    def make(width, extension, make_command):
+        variant_path = os.path.join(image_cache_dir, "{}.{}w{}".format(source_hash, width, extension))
+        if not os.path.exists(variant_path):
+            run_subprocess(make_command(variant_path + ".tmp" + extension), check=True, stdout=subprocess.DEVNULL)
+            os.replace(variant_path + ".tmp" + extension, variant_path)
+        return variant_path
+
+    # A png at each width is the input for everything else.
+    pngs = {}
+    for width in widths:
+        if width == original_width:
+            source = path
+        elif "magick" in tools:
+            source = make(width, ".resized.png", lambda out: [tools["magick"], path, "-resize", "{}x".format(width), "-strip", out])
+        else:
+            continue
+        if "oxipng" in tools:
+            pngs[width] = make(width, ".png", lambda out: [tools["oxipng"], "--quiet", "-o", "max", "--strip", "safe", "--out", out, source])
+        elif "optipng" in tools:
+            pngs[width] = make(width, ".png", lambda out: [tools["optipng"], "-quiet", "-o7", "-strip", "all", "-out", out, source])
+        else:
+            pngs[width] = source
+    if pngs == {original_width: path}:
+        # Nothing but the original itself. src already has that.
+        del pngs[original_width]
+
+    variants = {}
+    if "avifenc" in tools:
+        variants["image/avif"] = [(width, make(width, ".avif", lambda out: [tools["avifenc"], "--speed", "4", pngs.get(width, path), out])) for width in widths if width in pngs or width == original_width]
+    if "cwebp" in tools:
+        variants["image/webp"] = [(width, make(width, ".webp", lambda out: [tools["cwebp"], "-quiet", "-q", "85", "-resize", str(width), "0", path, "-o", out])) for width in widths]
+    if pngs:
+        variants["image/png"] = sorted(pngs.items())
+    return {content_type: variant_list for content_type, variant_list in variants.items() if variant_list}
+
+@lru_cache()
+def find_image_tools():
+    # Every tool is optional. Whatever isn't installed just means fewer variants.
+    tools = {}
+    for name, candidates in [
+        ("magick", ["magick", "convert"]),
+        ("oxipng", ["oxipng"]),
+        ("optipng", ["optipng"]),
+        ("cwebp", ["cwebp"]),
+        ("avifenc", ["avifenc"]),
+    ]:
+        for candidate in candidates:
+            path = shutil.which(candidate)
+            if path != None:
+                tools[name] = path
+                break
+    return tools
+
+stylesheet_key = "site/style.css"
+style_block_re = re.compile(r'(<!--BEGIN_(?:AUTHORITATIVE|GENERATED) "style" \{\{-->)(.*?)(<!--\}\} END_(?:AUTHORITATIVE|GENERATED)-->)', re.DOTALL)
+style_element_re = re.compile(r'\s*<style>(.*)</style>\s*', re.DOTALL)
+def get_stylesheet():
+    # The css from inside the <style> of the authoritative "style" definition.
+    definitions, consumers = load_definition_graph(find_html_sources())
+    return style_element_re.fullmatch(definitions["style"]).group(1)
+
+def link_stylesheet(contents, href):
+    # Replaces the body of the "style" block, wherever it was propagated to, with a <link> to the stylesheet.
+    link = '\n      <link rel="stylesheet" href="{}">\n    '.format(escape_attribute(href))
+    return style_block_re.sub(lambda match: match.group(1) + link + match.group(3), contents)
+
+def write_file_if_changed(path, contents):
+    try:
+        with open(path) as f:
+            if f.read() == contents:
+                profile_count("files unchanged")
+                return
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        profile_count("bytes written", f.write(contents))
+
+def get_publish_headers(key, *, immutable=False):
+    if immutable:
+        return {
+            "Cache-Control": "public, max-age=31536000, immutable",
+        }
+    return {
+        "Cache-Control": "max-age=0, must-revalidate",
+    }
+
+def get_publish_backend(destination):
+    if destination.startswith("s3://"):
+        return S3cmdPublishBackend(destination)
+    return DirectoryPublishBackend(destination)
+
+class S3cmdPublishBackend:
+    def __init__(self, bucket_url):
+        assert bucket_url.endswith("/"), "s3 destination must end with /"
+        self.bucket_url = bucket_url
+
+    def upload(self, key, path, headers):
+        cmd = [
+            "s3cmd", "put", "--quiet",
+            "--acl-public", "--no-preserve",
+            # mime magic is buggy for css files. guess mime type based on file extension only.
+            # See https://stackoverflow.com/questions/53708938/s3cmd-flagging-css-with-wrong-mime-type
+            "--no-mime-magic", "--guess-mime-type",
+        ]
+        for name, value in headers.items():
+            if name == "Content-Type":
+                # This overrides --guess-mime-type.
+                cmd.append("--mime-type=" + value)
+            else:
+                cmd.append("--add-header={}: {}".format(name, value))
+        cmd += [path, self.bucket_url + key]
+        run_subprocess(cmd, check=True)
+
+    def list_md5s(self):
+        # Returns {key: md5} for everything in the bucket.
+        cmd = ["s3cmd", "ls", "--recursive", "--list-md5", self.bucket_url]
+        output = run_subprocess(cmd, check=True, stdout=subprocess.PIPE).stdout.decode("utf8")
+        md5s = {}
+        for line in output.splitlines():
+            # 2025-05-19 08:25      1234   0123456789abcdef0123456789abcdef  s3://wolfesoftware.com/index.html
+            date, time_of_day, size, md5, url = line.split(None, 4)
+            md5s[url.removeprefix(self.bucket_url)] = md5
+        return md5s
+
+    def get_md5(self, key):
+        # Returns the md5 of one object, or None if it's not there.
+        cmd = ["s3cmd", "info", self.bucket_url + key]
+        result = run_subprocess(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode != 0: return None
+        match = re.search(r'^\s*MD5 sum:\s*([0-9a-f]+)\s*$', result.stdout.decode("utf8"), re.MULTILINE)
+        return match.group(1) if match != None else None
+
+class DirectoryPublishBackend:
+    # Publishes to a directory on the local file system, which is handy for testing.
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, key, path, headers):
+        destination_path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        shutil.copyfile(path, destination_path + ".tmp")
+        os.replace(destination_path + ".tmp", destination_path)
+
+    def list_md5s(self):
+        md5s = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                md5s[os.path.relpath(path, self.root).replace(os.sep, "/")] = hash_file(path, "md5")
+        return md5s
+
+    def get_md5(self, key):
+        return hash_file(os.path.join(self.root, key), "md5")
+
+# These definitions are generated by the build rather than written in a BEGIN_AUTHORITATIVE block.
+generated_definition_names = [
+    "recent-posts",
+    "archive-list",
+]
+def build_html(manifest, *, force=False):
+    with profile_span("load_definition_graph"):
+        definitions, consumers = load_definition_graph(find_html_sources())
+
+    consumed_names = {match.group(1) for contents, matches in consumers.values() for match in matches}
+    unknown_names = consumed_names - definitions.keys() - set(generated_definition_names)
+    if unknown_names:
+        sys.exit("\n".join("ERROR: BEGIN_GENERATED block for unknown definition: " + name for name in sorted(unknown_names)))
+    for name in sorted(definitions.keys() - consumed_names):
+        print("WARNING: definition is never used: " + name, file=sys.stderr)
+
+    # Files that only consume authoritative definitions can be done right away.
+    # That includes blog/base.html and blog/archive-template.html, which the generated pages are built from.
+    waiting_on_generated_definitions = []
+    for path, (contents, matches) in consumers.items():
+        if any(match.group(1) in generated_definition_names for match in matches):
+            waiting_on_generated_definitions.append(path)
+        else:
+            propagate_definitions(definitions, path, contents, matches)
+    assert "blog/base.html" not in waiting_on_generated_definitions, "can't use generated definitions in blog/base.html"
+    assert "blog/archive-template.html" not in waiting_on_generated_definitions, "can't use generated definitions in blog/archive-template.html"
+
+    with profile_span("generate_post_list"):
+        posts = generate_post_list(manifest, force=force)
+    definitions["recent-posts"] = format_post_list(posts[:recent_post_count])
+    with profile_span("generate_archive_pages"):
+        definitions["archive-list"] = generate_archive_pages(manifest, posts, force=force)
+    with profile_span("generate_search_index"):
+        generate_search_index(manifest, posts, force=force)
+
+    for path in waiting_on_generated_definitions:
+        contents, matches = consumers[path]
+        propagate_definitions(definitions, path, contents, matches)
+
+def find_html_sources():
+    # Every html file that might define or consume definitions, except for the ones compiled from markdown.
+    # Only what gets published counts, not whatever other html is lying around, like the output of --publish-to.
+    paths = []
+    for path in sorted(list_publishable_files()):
+        if not path.endswith(".html"): continue
+        if path.startswith(archive_dir + "/"): continue
+        if os.path.exists(path.removesuffix(".html") + ".md"): continue
+        paths.append(path)
+    return paths
+
+authoritative_re = re.compile(r'<!--BEGIN_AUTHORITATIVE "(.*?)" \{\{-->(.*?)<!--\}\} END_AUTHORITATIVE-->', re.DOTALL)
+generated_re = re.compile(r'<!--BEGIN_GENERATED "(.*?)" \{\{-->(.*?)<!--\}\} END_GENERATED-->', re.DOTALL)
+def load_definition_graph(paths):
+    # Reads each file once and returns (definitions, consumers):
+    #   definitions: {name: body} from every BEGIN_AUTHORITATIVE block.
+    #   consumers: {path: (contents, matches)} for every file with BEGIN_GENERATED blocks, where matches are from generated_re.
     definitions = {}
-    for name, body in re.findall(r'<!--BEGIN_AUTHORITATIVE "(.*?)" \{\{-->(.*?)<!--\}\} END_AUTHORITATIVE-->', contents, flags=re.DOTALL):
-        definitions[name] = body
+    defined_in = {}
+    consumers = {}
+    for path in paths:
+        with open(path) as f:
+            contents = f.read()
+        profile_count("bytes read", len(contents))
+        for match in authoritative_re.finditer(contents):
+            name = match.group(1)
+            if name in defined_in:
+                sys.exit("ERROR: {} is defined in both {} and {}".format(name, defined_in[name], path))
+            defined_in[name] = path
+            definitions[name] = match.group(2)
+        matches = list(generated_re.finditer(contents))
+        if matches:
+            consumers[path] = (contents, matches)
+    return definitions, consumers
+
+def propagate_definitions(definitions, path, contents, matches):
+    if all(match.group(2) == definitions[match.group(1)] for match in matches):
+        # Already up to date.
+        profile_count("files unchanged")
+        return
 
-    return definitions
+    pieces = []
+    position = 0
+    for match in matches:
+        pieces.append(contents[position:match.start(2)])
+        pieces.append(definitions[match.group(1)])
+        position = match.end(2)
+    pieces.append(contents[position:])
+    with profile_span("propagate_definitions", path=path), open(path, "w") as f:
+        profile_count("bytes written", f.write("".join(pieces)))
 
-def propagate_definitions(definitions, path):
-    with open(path) as f:
-        contents = f.read()
-    original_contents = contents
+# Returns a record for each post, most recent first, like:
+#   {"date": "2025-05-19", "title": "Hello Blog", "path": "blog/hello-blog.html", "date_html": "2025-05-19"}
+def generate_post_list(manifest, *, force=False):
+    markdown_paths = sorted(glob.glob("blog/*.md"))
+    git_history = load_git_history()
+    renderer_version = get_renderer_version()
+    with open("blog/base.html") as f:
+        html_base = f.read()
 
-    for match in reversed(list(re.finditer(r'<!--BEGIN_GENERATED "(.*?)" \{\{-->(.*?)<!--\}\} END_GENERATED-->', contents, flags=re.DOTALL))):
-        body = definitions[match.group(1)]
-        contents = contents[:match.span(2)[0]] + body + contents[match.span(2)[1]:]
+    compiled_posts = []
+    stale_posts = []
+    for markdown_path in markdown_paths:
+        html_path = markdown_path.replace(".md", ".html")
+        with open(markdown_path) as f:
+            markdown_contents = f.read()
+        profile_count("bytes read", len(markdown_contents))
+        history = git_history.get(markdown_path, [])
+        input_hash = hash_inputs(markdown_contents, html_base, history, renderer_version)
+        entry = manifest.get(html_path, {})
+        if not force and is_up_to_date(manifest, html_path, input_hash) and is_post_cache_complete(entry):
+            profile_count("posts unchanged")
+            compiled_posts.append((entry["post"], entry["rss_item"]))
+        else:
+            stale_posts.append((markdown_path, history, html_path, input_hash))
 
-    if original_contents != contents:
-        with open(path, "w") as f:
-            f.write(contents)
+    if len(stale_posts) == 1:
+        # Not worth starting up worker processes for. This is the common case for --watch.
+        [(markdown_path, history, html_path, input_hash)] = stale_posts
+        with profile_span("compile_blog_file", path=markdown_path):
+            post, rss_element, terms = compile_blog_file(markdown_path, history, html_base)
+        rss_item = save_rss_item(rss_element)
+        search_terms = save_search_terms(terms)
+        record_output(manifest, html_path, input_hash, post=post, rss_item=rss_item, search_terms=search_terms)
+        compiled_posts.append((post, rss_item))
+    elif len(stale_posts) > 1:
+        # Each post is independent, so compile them in parallel.
+        # The results come back in the order of stale_posts regardless of which worker finishes first.
+        with ProcessPoolExecutor() as executor, profile_span("compile posts in parallel", posts=len(stale_posts)):
+            results = executor.map(compile_blog_file if profiler == None else partial(run_profiled, compile_blog_file),
+                [markdown_path for markdown_path, history, html_path, input_hash in stale_posts],
+                [history for markdown_path, history, html_path, input_hash in stale_posts],
+                itertools.repeat(html_base),
+            )
+            for (markdown_path, history, html_path, input_hash), result in zip(stale_posts, results):
+                if profiler != None:
+                    result, spans, counters = result
+                    profiler.merge(spans, counters)
+                post, rss_element, terms = result
+                rss_item = save_rss_item(rss_element)
+                search_terms = save_search_terms(terms)
+                record_output(manifest, html_path, input_hash, post=post, rss_item=rss_item, search_terms=search_terms)
+                compiled_posts.append((post, rss_item))
+
+    compiled_posts.sort(key=lambda compiled_post: (compiled_post[0]["date"], compiled_post[0]["path"]), reverse=True)
+
+    with profile_span("generate_rss"):
+        generate_rss(manifest, [rss_item for post, rss_item in compiled_posts[:rss_item_limit]], force=force)
+
+    return [post for post, rss_item in compiled_posts]
+
+def is_post_cache_complete(entry):
+    # The manifest entry for a post refers to files in the cache, which might have been deleted.
+    return (
+        "post" in entry and "search_terms" in entry and
+        os.path.exists(get_rss_item_path(entry["rss_item"])) and
+        os.path.exists(get_search_terms_path(entry["search_terms"]))
+    )
 
-def generate_post_list():
-    index_elements = []
-    rss_elements = []
+def format_post_list(posts):
+    return "\n" + "\n".join(
+        '<li>{} - <a href=/{}>{}</a></li>'.format(post["date_html"], post["path"], post["title"])
+        for post in posts
+    ) + "\n"
 
-    compile_blog_file("blog/hello-blog.md", index_elements, rss_elements)
+# The landing pages only list this many posts. The rest are in the archive pages, one per year.
+recent_post_count = 10
+archive_dir = "blog/archive"
+def generate_archive_pages(manifest, posts, *, force=False):
+    # Writes blog/archive/YYYY.html for each year with posts, and returns the list of links to them.
+    with open("blog/archive-template.html") as f:
+        archive_template = f.read()
+    renderer_version = get_renderer_version()
+    posts_by_year = {}
+    for post in posts:
+        posts_by_year.setdefault(post["date"][:4], []).append(post)
 
-    # The date in YYYY-MM-DD format comes before the title, so this will sort chronologically:
-    index_elements.sort(reverse=True)
-    post_list_html = "\n" + "\n".join(index_elements) + "\n"
+    for year, year_posts in posts_by_year.items():
+        archive_path = "{}/{}.html".format(archive_dir, year)
+        # Posts from other years don't matter, so a new post only rewrites the page for its year.
+        input_hash = hash_inputs(archive_template, year_posts, renderer_version)
+        if not force and is_up_to_date(manifest, archive_path, input_hash): continue
+        write_file_if_changed(archive_path, fill_template(compile_template(archive_template), {
+            "YEAR": year,
+            "POST_LIST": format_post_list(year_posts),
+        }))
+        record_output(manifest, archive_path, input_hash)
 
-    # Build full rss.xml document.
+    # Years that don't have any posts anymore.
+    for archive_path in glob.glob(archive_dir + "/*.html"):
+        if os.path.basename(archive_path).removesuffix(".html") not in posts_by_year:
+            os.remove(archive_path)
+            manifest.pop(archive_path, None)
+
+    return "\n" + "\n".join(
+        "<li><a href=/{}/{}.html>{}</a> ({})</li>".format(archive_dir, year, year, len(year_posts))
+        for year, year_posts in posts_by_year.items()
+    ) + "\n"
+
+# The feed only has the most recent posts, so what every subscriber polls stays the same size as the blog grows.
+rss_item_limit = 20
+# If True, each feed item only has the beginning of the post, up to the first subheading, and a link to the rest.
+rss_summary_only = False
+# Each <item> is saved here, named by its hash, so rss.xml can be assembled without recompiling or rereading every post.
+rss_item_cache_dir = ".build-cache/rss-items"
+def get_rss_item_path(rss_item):
+    return os.path.join(rss_item_cache_dir, "{}.xml".format(rss_item))
+def save_rss_item(rss_element):
+    rss_item = hashlib.sha256(rss_element.encode("utf8")).hexdigest()
+    write_file_if_changed(get_rss_item_path(rss_item), rss_element)
+    return rss_item
+
+def generate_rss(manifest, rss_items, *, force=False):
+    # rss_items are hashes from save_rss_item(), most recent first.
     with open("blog/rss-template.xml") as f:
         base_rss = f.read()
-    rss_content = (base_rss
-        .replace("{{LAST_BUILD_DATE}}", email.utils.format_datetime(datetime.datetime.now(datetime.UTC), usegmt=True))
-        .replace("{{ITEMS}}", "".join(rss_elements))
-    )
-    # Only update if something changed, other than that timestamp we just threw in there.
-    with open("blog/rss.xml") as f:
-        previous_rss_content = f.read()
+    input_hash = hash_inputs(base_rss, rss_items)
+    if not force and is_up_to_date(manifest, "blog/rss.xml", input_hash):
+        profile_count("files unchanged")
+        return
+
+    # Only update if something changed, other than the timestamp.
+    previous_entry = manifest.get("blog/rss.xml")
+    previous_rss_content = None
+    if previous_entry != None and previous_entry["output"] == hash_file("blog/rss.xml"):
+        # The file is what we wrote last time, so the items are all we need to compare, not the whole document.
+        if previous_entry["inputs"] == input_hash:
+            return
+    else:
+        # We don't know what's in the file, such as in a fresh clone. Compare the text.
+        with open("blog/rss.xml") as f:
+            previous_rss_content = f.read()
+
+    items = []
+    for rss_item in rss_items:
+        with open(get_rss_item_path(rss_item)) as f:
+            items.append(f.read())
+    rss_content = fill_template(compile_template(base_rss), {
+        "LAST_BUILD_DATE": email.utils.format_datetime(datetime.datetime.now(datetime.UTC), usegmt=True),
+        "ITEMS": "".join(items),
+    })
     def strip_last_build_date(rss_content):
         start = rss_content.index("<lastBuildDate>")
         end = rss_content.index("\n", start)
         stripped = rss_content[:start] + rss_content[end:]
         return stripped
-    if strip_last_build_date(previous_rss_content) != strip_last_build_date(rss_content):
+    if previous_rss_content == None or strip_last_build_date(previous_rss_content) != strip_last_build_date(rss_content):
         with open("blog/rss.xml", "w") as f:
             f.write(rss_content)
+    record_output(manifest, "blog/rss.xml", input_hash)
+
+
+# The search index is a json file per term prefix, each like:
+#   {"blog": [[0, 3, 17], [2, 5]], "blob": [[1, 0]]}
+# which says "blog" is word 3 and word 17 in post 0, and word 5 in post 2.
+# posts.json lists [path, title] by post id. site/search.js only downloads the files for the words it's looking for.
+search_index_dir = "blog/search"
+search_shard_prefix_length = 2
+# The terms of each post are saved here, named by their hash, so the index can be updated one post at a time.
+search_terms_cache_dir = ".build-cache/search-terms"
+search_term_re = re.compile(r'\w+')
+def tokenize_for_search(text):
+    # Returns {term: [position, ...]}, where a position counts words from the start of the text.
+    terms = {}
+    for position, match in enumerate(search_term_re.finditer(text.lower())):
+        terms.setdefault(match.group(), []).append(position)
+    return terms
+def get_search_terms_path(search_terms):
+    return os.path.join(search_terms_cache_dir, "{}.json".format(search_terms))
+def save_search_terms(terms):
+    contents = json.dumps(terms, sort_keys=True, separators=(",", ":"))
+    search_terms = hashlib.sha256(contents.encode("utf8")).hexdigest()
+    write_file_if_changed(get_search_terms_path(search_terms), contents)
+    return search_terms
+def load_search_terms(search_terms):
+    with open(get_search_terms_path(search_terms)) as f:
+        return json.load(f)
+def get_search_shard(term):
+    prefix = term[:search_shard_prefix_length]
+    if re.fullmatch(r'[a-z0-9_]+', prefix):
+        return prefix
+    # Keep the file names ascii. site/search.js does the same thing.
+    return "u" + "-".join("{:x}".format(ord(c)) for c in prefix)
 
-    return post_list_html
+def generate_search_index(manifest, posts, *, force=False):
+    # Post ids count up from the oldest post, so a new post doesn't renumber the others.
+    posts = posts[::-1]
+    documents = [[post["path"], post["title"]] for post in posts]
+    search_terms = [manifest[post["path"]]["search_terms"] for post in posts]
+    documents_path = search_index_dir + "/posts.json"
+    input_hash = hash_inputs(documents, search_terms)
+    if not force and is_up_to_date(manifest, documents_path, input_hash):
+        return
 
+    previous_entry = manifest.get(documents_path)
+    if (
+        not force and previous_entry != None and previous_entry["output"] == hash_file(documents_path) and
+        all(os.path.exists(get_search_terms_path(previous)) for previous in previous_entry["search_terms"])
+    ):
+        # Only touch the shards that have terms from the posts that changed.
+        previous_search_terms = previous_entry["search_terms"]
+        changed_ids = [
+            i for i in range(max(len(search_terms), len(previous_search_terms)))
+            if i >= len(search_terms) or i >= len(previous_search_terms) or search_terms[i] != previous_search_terms[i]
+        ]
+        start_over = False
+    else:
+        # We don't know what's in the shards. Start over.
+        previous_search_terms = []
+        changed_ids = list(range(len(search_terms)))
+        start_over = True
 
-def compile_blog_file(markdown_path, index_elements, rss_elements, *, do_internal_links=False, toc_levels=0):
+    affected_shards = set()
+    for i in changed_ids:
+        if i < len(previous_search_terms):
+            affected_shards.update(get_search_shard(term) for term in load_search_terms(previous_search_terms[i]))
+    new_postings = {}
+    for i in changed_ids:
+        if i < len(search_terms):
+            for term, positions in load_search_terms(search_terms[i]).items():
+                new_postings.setdefault(get_search_shard(term), {}).setdefault(term, []).append([i] + positions)
+    affected_shards.update(new_postings.keys())
+
+    changed_ids = set(changed_ids)
+    for shard in sorted(affected_shards):
+        shard_path = "{}/{}.json".format(search_index_dir, shard)
+        index = {}
+        if not start_over:
+            try:
+                with open(shard_path) as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                pass
+        for term in list(index.keys()):
+            index[term] = [posting for posting in index[term] if posting[0] not in changed_ids]
+        for term, postings in new_postings.get(shard, {}).items():
+            index[term] = sorted(index.get(term, []) + postings)
+        index = {term: postings for term, postings in index.items() if postings}
+        # An empty shard rather than no shard, because publishing never deletes anything,
+        # and the old shard would stay online with postings for the wrong post ids.
+        if index or os.path.exists(shard_path):
+            write_file_if_changed(shard_path, json.dumps(index, sort_keys=True, separators=(",", ":")))
+    if start_over:
+        for shard_path in glob.glob(search_index_dir + "/*.json"):
+            if shard_path != documents_path and os.path.basename(shard_path).removesuffix(".json") not in affected_shards:
+                write_file_if_changed(shard_path, "{}")
+
+    write_file_if_changed(documents_path, json.dumps(documents, separators=(",", ":")))
+    record_output(manifest, documents_path, input_hash, search_terms=search_terms)
+
+# Highlighted code blocks are saved here, named by the hash of the language, the code, and the highlighter rules.
+# Editing a post, or anything else in the renderer, doesn't need to highlight its code blocks again.
+highlight_cache_dir = ".build-cache/highlight"
+def highlight_code_cached(language, code):
+    path = os.path.join(highlight_cache_dir, "{}.html".format(hash_inputs(language, code, get_syntax_highlighter_version())))
+    try:
+        with open(path) as f:
+            profile_count("highlight cache hits")
+            return f.read()
+    except FileNotFoundError:
+        pass
+    with profile_span("highlight_code", language=language):
+        html = get_markdown_looks_good().highlight_code(language, code)
+    os.makedirs(highlight_cache_dir, exist_ok=True)
+    # Parallel builds might write the same file, so don't let anyone read half of one.
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(html)
+    os.replace(tmp_path, path)
+    return html
+@lru_cache()
+def get_syntax_highlighter_version():
+    return get_markdown_looks_good().get_syntax_highlighter_version()
+
+# Writes the .html file next to the .md file, and returns (post, rss_element, terms) for the caller to assemble,
+# where post is a record like generate_post_list() returns, and terms are from tokenize_for_search().
+# history is this file's entry from load_git_history().
+# html_base is the contents of blog/base.html.
+def compile_blog_file(markdown_path, history, html_base, *, do_internal_links=False, toc_levels=0):
     html_path = markdown_path.replace(".md", ".html")
     assert html_path == escape_attribute(html_path), "need to add escaping for urls and stuff"
     with open(markdown_path) as f:
@@ -129,32 +986,46 @@ def compile_blog_file(markdown_path, index_elements, rss_elements, *, do_interna
     # Parameters
     title = re.match(r'^# (.*)', markdown_contents).group(1)
     assert title == escape_text(title)
-    date_html, src_html = generate_version_control_html(markdown_path)
-    body_html = markdown_to_html(markdown_contents, do_internal_links=do_internal_links, toc_levels=toc_levels)
+    date, date_html, src_html = generate_version_control_html(markdown_path, history)
     # Date is in RFC-something format: Sat, 07 Sep 2002 00:00:01 GMT
-    cmd = ["git", "rev-list", "-n1", "--no-commit-header", "--pretty=tformat:%aD", "HEAD", "--", markdown_path]
-    pub_date = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf8").rstrip()
-    if len(pub_date) == 0:
+    if len(history) > 0:
+        # The most recent commit comes first.
+        pub_date = history[0][1]
+    else:
         # Not committed yet. Assume now.
         pub_date = email.utils.format_datetime(datetime.datetime.now(datetime.UTC), usegmt=True)
 
+    # Parse once, and render it for the page, the rss feed, and the search index.
+    markdown_looks_good = get_markdown_looks_good()
+    with profile_span("parse_markdown"):
+        document = markdown_looks_good.parse_markdown(markdown_contents)
+
     # output html
-    with open("blog/base.html") as f:
-        html_base = f.read()
-    html = (html_base
-        .replace("{{TITLE}}", title)
-        .replace("{{BODY}}", body_html)
-        .replace("{{DATE}}", date_html)
-        .replace("{{SRC}}", src_html)
-    )
-    with open(html_path, "w") as f:
-        f.write(html)
+    with profile_span("render html"), open(html_path, "w") as f:
+        write_template(f, compile_template(html_base), {
+            "TITLE": title,
+            # The body is streamed into the file as it's rendered.
+            "BODY": lambda out: markdown_looks_good.render(markdown_looks_good.HtmlRenderer(do_internal_links=do_internal_links, toc_levels=toc_levels, highlight=highlight_code_cached), document, out=out),
+            "DATE": date_html,
+            "SRC": src_html,
+        })
+        profile_count("bytes written", f.tell())
+    url = "https://wolfesoftware.com/" + html_path
+    feed_document = document
+    if rss_summary_only:
+        feed_document = summarize_document(document)
+    with profile_span("render feed html"):
+        feed_html = markdown_looks_good.render(markdown_looks_good.FeedHtmlRenderer(do_internal_links=do_internal_links, base_url=url), feed_document)
+    if feed_document is not document:
+        feed_html += "<p><a href={}>Continue reading</a></p>\n".format(escape_attribute(url))
+    with profile_span("tokenize_for_search"):
+        terms = tokenize_for_search(markdown_looks_good.render(markdown_looks_good.PlainTextRenderer(), document))
 
     # output index
-    index_elements.append('<li>{} - <a href=/{}>{}</a></li>'.format(date_html, html_path, title))
+    post = {"date": date, "title": title, "path": html_path, "date_html": date_html}
 
     # output rss
-    rss_elements.append("""\
+    rss_element = """\
       <item>
          <title>{TITLE}</title>
          <pubDate>{PUB_DATE}</pubDate>
@@ -167,13 +1038,22 @@ def compile_blog_file(markdown_path, index_elements, rss_elements, *, do_interna
         TITLE=title,
         PUB_DATE=pub_date,
         HTML_PATH=html_path,
-        BODY=escape_cdata(body_html),
-    ))
+        BODY=escape_cdata(feed_html),
+    )
+
+    return post, rss_element, terms
+
+def summarize_document(document):
+    # Returns a document with the blocks before the first subheading, or the same document if there's nothing to cut.
+    markdown_looks_good = get_markdown_looks_good()
+    for i, block in enumerate(document.blocks):
+        if i > 0 and type(block) == markdown_looks_good.Heading:
+            return markdown_looks_good.Document(document.blocks[:i], [], document.anchors, document.internal_links)
+    return document
 
-def generate_version_control_html(path):
+def generate_version_control_html(path, history):
     # Dates are in YYYY-MM-DD format
-    cmd = ["git", "rev-list", "--no-commit-header", "--pretty=tformat:%as", "HEAD", "--", path]
-    dates = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf8").split()
+    dates = [short_date for short_date, rfc_date in history]
     if len(dates) == 0:
         # Not committed yet. Assume now.
         dates = [datetime.datetime.now().isoformat()[:10]]
@@ -190,45 +1070,224 @@ def generate_version_control_html(path):
     source_url = "https://github.com/thejoshwolfe/wolfesoftware.com/blob/master/" + path
     source_link = "<a href={}>src</a>".format(escape_attribute(source_url))
 
-    return timestamp_blurb, source_link
+    # The date of the first commit is when the post was published.
+    return dates[0], timestamp_blurb, source_link
 
-def markdown_to_html(*args, **kwargs):
+template_slot_re = re.compile(r'\{\{([A-Z_]+)\}\}')
+@lru_cache()
+def compile_template(text):
+    # "<title>{{TITLE}}</title>" compiles to ("<title>", "TITLE", "</title>").
+    # Even indexes are literal text, and odd indexes are slot names.
+    return tuple(template_slot_re.split(text))
+def fill_template(segments, values):
+    # Values are inserted in one pass, so they never get scanned for {{SLOTS}} themselves.
+    return "".join(values[segment] if i % 2 else segment for i, segment in enumerate(segments))
+def write_template(out, segments, values):
+    # Same as fill_template(), but writes to out, and a value can also be a function that writes to out itself.
+    for i, segment in enumerate(segments):
+        if i % 2 == 0:
+            out.write(segment)
+        elif callable(values[segment]):
+            values[segment](out)
+        else:
+            out.write(values[segment])
+
+git_history_cache_path = ".build-cache/git-history.json"
+def load_git_history():
+    # Returns a dict like:
+    #   {"blog/hello-blog.md": [["2025-05-19", "Mon, 19 May 2025 04:25:28 -0400"], ...]}
+    # with one entry per commit that touched the path, most recent first.
+    # The result is cached on disk keyed by HEAD, and when HEAD moves forward only the new commits are walked.
+    head = run_subprocess(["git", "rev-parse", "HEAD"], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf8").rstrip()
+    with profile_span("load_git_history"):
+        return load_git_history_at(head)
+
+@lru_cache(maxsize=1)
+def load_git_history_at(head):
+    try:
+        with open(git_history_cache_path) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = None
+
+    history = {}
+    rev_range = head
+    if cache != None:
+        if cache["head"] == head:
+            return cache["history"]
+        if run_subprocess(["git", "merge-base", "--is-ancestor", cache["head"], head], stderr=subprocess.DEVNULL).returncode == 0:
+            history = cache["history"]
+            rev_range = cache["head"] + ".." + head
+        # else: history was rewritten. Start over.
+
+    for path, entries in walk_git_history(rev_range).items():
+        history[path] = entries + history.get(path, [])
+
+    os.makedirs(os.path.dirname(git_history_cache_path), exist_ok=True)
+    with open(git_history_cache_path, "w") as f:
+        json.dump({"head": head, "history": history}, f)
+    return history
+
+def walk_git_history(rev_range):
+    # One pass over the history instead of a git rev-list per file.
+    cmd = [
+        "git", "-c", "core.quotePath=false", "log", "--no-renames", "--name-only",
+        # Dates are in YYYY-MM-DD format and RFC-something format: Sat, 07 Sep 2002 00:00:01 GMT
+        "--format=%x00%as %aD",
+        rev_range, "--",
+    ]
+    output = run_subprocess(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf8")
+    history = {}
+    for commit in output.split("\0")[1:]:
+        header, *paths = commit.split("\n")
+        short_date, rfc_date = header.split(" ", 1)
+        for path in paths:
+            if not path: continue
+            history.setdefault(path, []).append([short_date, rfc_date])
+    return history
+
+build_manifest_path = ".build-cache/manifest.json"
+# The manifest is a dict like:
+#   {"blog/hello-blog.html": {"inputs": "<hash>", "output": "<hash>", ...extra fields...}}
+# An output is up to date when the hash of everything that went into it matches,
+# and the file on disk is still what we wrote last time.
+def load_build_manifest():
+    try:
+        with open(build_manifest_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+def save_build_manifest(manifest):
+    os.makedirs(os.path.dirname(build_manifest_path), exist_ok=True)
+    with open(build_manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def is_up_to_date(manifest, output_path, input_hash):
+    entry = manifest.get(output_path)
+    if entry == None: return False
+    return entry["inputs"] == input_hash and entry["output"] == hash_file(output_path)
+def record_output(manifest, output_path, input_hash, **extra):
+    manifest[output_path] = dict(inputs=input_hash, output=hash_file(output_path), **extra)
+
+def hash_inputs(*inputs):
+    return hashlib.sha256(json.dumps(inputs).encode("utf8")).hexdigest()
+def hash_file(path, algorithm="sha256"):
+    try:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, algorithm).hexdigest()
+            profile_count("bytes hashed", f.tell())
+            return digest
+    except FileNotFoundError:
+        return None
+
+@lru_cache()
+def get_renderer_version():
+    # Any change to the code that generates html invalidates everything it generated.
+    return hash_inputs(
+        hash_file(__file__),
+        hash_file(markdown_looks_good_path),
+    )
+
+markdown_looks_good_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deps/markdown-looks-good/markdown_looks_good.py")
+@lru_cache()
+def get_markdown_looks_good():
     import importlib.util
-    spec = importlib.util.spec_from_file_location("markdown_asdf", os.path.join(os.path.dirname(os.path.abspath(__file__)), "deps/markdown-looks-good/markdown_looks_good.py"))
+    spec = importlib.util.spec_from_file_location("markdown_looks_good", markdown_looks_good_path)
     markdown_looks_good = importlib.util.module_from_spec(spec)
     sys.modules["markdown_looks_good"] = markdown_looks_good
-    spec.loader.exec_module(markdown_looks_good)
-    return markdown_looks_good.markdown_to_html(*args, **kwargs)
-
-attribute_substitutions = {
-    # https://www.w3.org/TR/2012/WD-html-markup-20120329/syntax.html#syntax-attr-unquoted
-    '"': "&quot;",
-    "'": "&apos;",
-    "=": "&#61;",
-    ">": "&gt;",
-    "<": "&lt;",
-    "`": "&#96;",
-    "&": "&amp;",
-}
-attribute_escape_re = re.compile(r'[{}]'.format(r''.join(attribute_substitutions.keys())))
+    # This includes compiling its regexes.
+    with profile_span("import markdown_looks_good"):
+        spec.loader.exec_module(markdown_looks_good)
+    return markdown_looks_good
+
+# The renderer's escaping is used for everything, so there's only one implementation of it.
 def escape_attribute(text):
-    return attribute_escape_re.sub((lambda m: attribute_substitutions[m.group()]), text)
-text_substitutions = {
-    ">": "&gt;",
-    "<": "&lt;",
-    "&": "&amp;",
-}
-text_escape_re = re.compile(r'[{}]'.format(r''.join(text_substitutions.keys())))
+    return get_markdown_looks_good().escape_attribute(text)
 def escape_text(text):
-    return text_escape_re.sub((lambda m: text_substitutions[m.group()]), text)
-
+    return get_markdown_looks_good().escape_text(text)
 def escape_cdata(text):
-    return text.replace("]]>", "]]]]><![CDATA[>")
+    return get_markdown_looks_good().escape_cdata(text)
+
+
+# --profile records spans of time and adds up counters. When it's off, profiler is None,
+# and profile_span() and profile_count() do next to nothing.
+profiler = None
+default_profile_trace_path = ".build-cache/profile-trace.json"
+null_span = contextlib.nullcontext()
+def profile_span(name, **args):
+    if profiler == None: return null_span
+    return profiler.span(name, args)
+def profile_count(name, amount=1):
+    if profiler == None: return
+    profiler.count(name, amount)
+
+class Profiler:
+    def __init__(self):
+        # [(name, start_ns, end_ns, pid, tid, args)]
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, args):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter_ns(), os.getpid(), threading.get_ident(), args))
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, spans, counters):
+        # From run_profiled() in a worker process.
+        self.spans.extend(spans)
+        for name, amount in counters.items():
+            self.count(name, amount)
+
+    def print_summary(self):
+        # Spans include the time of the spans inside them.
+        totals = {}
+        for name, start, end, pid, tid, args in self.spans:
+            calls, total = totals.get(name, (0, 0))
+            totals[name] = (calls + 1, total + end - start)
+        print("{:>10} {:>6}  {}".format("total ms", "calls", "span"))
+        for name, (calls, total) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True):
+            print("{:>10.1f} {:>6}  {}".format(total / 1e6, calls, name))
+        for name, amount in sorted(self.counters.items()):
+            print("{:>17}  {}".format(amount, name))
+
+    def save_trace(self, path):
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/
+        events = []
+        for pid in sorted({pid for name, start, end, pid, tid, args in self.spans}):
+            events.append({"ph": "M", "name": "process_name", "pid": pid, "args": {"name": "build.py" if pid == os.getpid() else "worker"}})
+        for name, start, end, pid, tid, args in self.spans:
+            events.append({"ph": "X", "name": name, "ts": start / 1000, "dur": (end - start) / 1000, "pid": pid, "tid": tid, "args": args})
+        events.append({"ph": "C", "name": "counters", "ts": time.perf_counter_ns() / 1000, "pid": os.getpid(), "args": self.counters})
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+        print("wrote trace: " + path)
+
+def run_profiled(function, *args):
+    # For worker processes, which can't add to the parent's profiler.
+    # Returns (result, spans, counters) for the parent to give to Profiler.merge().
+    global profiler
+    profiler = Profiler()
+    with profile_span(function.__name__):
+        result = function(*args)
+    return result, profiler.spans, profiler.counters
 
+def run_subprocess(cmd, **kwargs):
+    profile_count("subprocesses")
+    with profile_span("subprocess " + os.path.basename(cmd[0]), cmd=" ".join(cmd)):
+        return subprocess.run(cmd, **kwargs)
 
 @lru_cache()
 def get_repo_root():
-    return subprocess.run(["git", "rev-parse", "--show-toplevel"], check=True, stdout=subprocess.PIPE).stdout.decode("utf8").rstrip()
+    return run_subprocess(["git", "rev-parse", "--show-toplevel"], check=True, stdout=subprocess.PIPE).stdout.decode("utf8").rstrip()
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-import sys, re, io
+import os, sys, re, io
+import hashlib
+import itertools, urllib.parse
 from collections import Counter
 
 allowed_toc_levels = (0, 2, 3, 4)
@@ -30,29 +32,34 @@ def main():
     args = parser.parse_args()
 
     if args.input == "-":
-        input_contents = std.stdin.read()
+        input_contents = sys.stdin.read()
     else:
         with open(args.input) as f:
             input_contents = f.read()
 
-    html = markdown_to_html(input_contents,
-        do_internal_links=not args.no_internal_links,
-        toc_levels=args.toc_levels,
-    )
-
     if args.template:
         with open(args.template) as f:
             template_contents = f.read()
         split_template = template_contents.split("{{GENERATED_HTML_GOES_HERE}}")
         if len(split_template) != 2:
             sys.exit("ERROR: template must contain the bytes {{GENERATED_HTML_GOES_HERE}} exactly once: " + args.template)
-        html = split_template[0] + html + split_template[1]
-
+    else:
+        split_template = ["", ""]
+
+    # Stream the html into the output rather than building it all in memory first.
+    def write_output(out):
+        out.write(split_template[0])
+        markdown_to_html(input_contents,
+            do_internal_links=not args.no_internal_links,
+            toc_levels=args.toc_levels,
+            out=out,
+        )
+        out.write(split_template[1])
     if args.output == "-":
-        print(html, end="")
+        write_output(sys.stdout)
     else:
         with open(args.output, "w") as f:
-            f.write(html)
+            write_output(f)
 
 # Used in a first pass to preview what should be a link.
 definition_re = re.compile(
@@ -71,14 +78,12 @@ structural_re = re.compile(
     , re.MULTILINE
 )
 # Major syntax is contained within a structural element and can contain minor syntax.
-major_syntax_re_template = (
+major_syntax_re = re.compile(
     r'(?P<bold>\*\*(?P<bold_inner>.+?)\*\*)|'
     r'(?P<italics>_(?P<italics_inner>.+?)_)|'
     r'(?P<external_link>https?://\S+)|'
 
-    # Then a dynamic set of internal links from definition_re. something like:
-    # r'(?P<internal_link>Endnote `Something`|`MyStruct`|...)'
-    r'(?P<internal_link>(?<!\w)(?:%s)(?!\w))|'
+    # Then a dynamic set of internal links from definition_re goes here. See InternalLinkMatcher.
 
     # Then finally the same thing as minor_syntax_re.
     # This has to come after links which might also count as `code`.
@@ -89,20 +94,206 @@ minor_syntax_re = re.compile(
     r'(?P<code>`(?P<code_inner>.+?)`)'
 )
 
-def markdown_to_html(contents, *, do_internal_links, toc_levels):
-    assert toc_levels in allowed_toc_levels, repr((toc_levels, allowed_toc_levels))
-
+# If out is given, the html is written to it with out.write() as it's generated, and None is returned.
+# Otherwise, the html is returned as a str.
+def markdown_to_html(contents, *, do_internal_links, toc_levels, out=None):
+    document = parse_markdown(contents)
+    return render(HtmlRenderer(do_internal_links=do_internal_links, toc_levels=toc_levels), document, out=out)
+
+# Same as markdown_to_html, but for an html page that isn't the one the document will be hosted on, like an rss feed.
+# There's no table of contents or decorative markdown symbols,
+# and internal links are made absolute by prefixing them with base_url.
+def markdown_to_feed_html(contents, *, do_internal_links, base_url, out=None):
+    return render(FeedHtmlRenderer(do_internal_links=do_internal_links, base_url=base_url), parse_markdown(contents), out=out)
+
+def markdown_to_plain_text(contents, *, out=None):
+    return render(PlainTextRenderer(), parse_markdown(contents), out=out)
+
+# Renders several documents as though they were one, such as a long reference split into pages.
+# Text in any document that matches an anchor in any other document becomes a link to that page.
+# documents is a list of (url, contents), where url is how the other pages link to that one, e.g. "part-2.html".
+# If executor is given, like a concurrent.futures.ProcessPoolExecutor, the documents are scanned and rendered with its map().
+# Returns (htmls, link_report), where htmls is in the same order as documents.
+# Nothing is printed for broken links. They're in the LinkReport instead.
+def markdown_to_html_batch(documents, *, do_internal_links, toc_levels, executor=None):
+    if executor == None:
+        map_function = map
+    else:
+        # Each chunk is pickled at once, so the SiteIndex is only copied to the workers once per chunk instead of once per document.
+        chunksize = max(1, len(documents) // (os.cpu_count() or 1))
+        map_function = lambda function, *iterables: executor.map(function, *iterables, chunksize=chunksize)
+    urls = [url for url, contents in documents]
+    contents_list = [contents for url, contents in documents]
+
+    # Every document's anchors have to be known before any of them can be parsed.
+    anchor_scans = list(map_function(scan_anchors, contents_list))
+    site_index = SiteIndex(urls, anchor_scans)
+
+    results = list(map_function(render_batch_document,
+        contents_list,
+        anchor_scans,
+        itertools.repeat(site_index),
+        itertools.repeat(do_internal_links),
+        itertools.repeat(toc_levels),
+    ))
+
+    links = []
+    broken_links = []
+    for url, anchor_scan, (html, internal_links) in zip(urls, anchor_scans, results):
+        for slug in sorted(internal_links):
+            if slug in anchor_scan.counts:
+                links.append((url, url, slug))
+            elif slug in site_index.urls:
+                links.append((url, site_index.urls[slug], slug))
+            else:
+                broken_links.append((url, slug))
+    duplicate_anchors = {}
+    for url, anchor_scan in zip(urls, anchor_scans):
+        for slug in anchor_scan.counts:
+            duplicate_anchors.setdefault(slug, []).append(url)
+    duplicate_anchors = {slug: urls for slug, urls in duplicate_anchors.items() if len(urls) > 1}
+
+    return [html for html, internal_links in results], LinkReport(links, broken_links, duplicate_anchors)
+
+def render_batch_document(contents, anchor_scan, site_index, do_internal_links, toc_levels):
+    # For markdown_to_html_batch(). Returns (html, internal_links).
+    document = parse_scanned_markdown(contents, anchor_scan, site_index.link_matcher)
+    renderer = HtmlRenderer(do_internal_links=do_internal_links, toc_levels=toc_levels, site_index=site_index)
+    return render(renderer, document), document.internal_links
+
+class SiteIndex:
+    # Where the anchors are in a batch of documents.
+    __slots__ = ("urls", "link_matcher")
+    def __init__(self, urls, anchor_scans):
+        # {slug: url}. If more than one document has the anchor, the first one gets the links.
+        self.urls = {}
+        texts = []
+        for url, anchor_scan in zip(urls, anchor_scans):
+            for slug in anchor_scan.counts:
+                self.urls.setdefault(slug, url)
+            texts.extend(anchor_scan.texts)
+        self.link_matcher = InternalLinkMatcher(texts)
+
+class LinkReport:
+    __slots__ = ("links", "broken_links", "duplicate_anchors")
+    def __init__(self, links, broken_links, duplicate_anchors):
+        # List of (from_url, to_url, slug) for every internal link. from_url == to_url for a link within a page.
+        self.links = links
+        # List of (url, slug) for links to anchors that aren't in any of the documents.
+        self.broken_links = broken_links
+        # {slug: [url, ...]} for anchors in more than one document.
+        self.duplicate_anchors = duplicate_anchors
+    def warnings(self):
+        return [
+            "WARNING: broken link: {}: {}".format(url, slug) for url, slug in self.broken_links
+        ] + [
+            "WARNING: anchor is in more than one document: {}: {}".format(slug, ", ".join(urls)) for slug, urls in sorted(self.duplicate_anchors.items())
+        ]
+
+# Parse once with parse_markdown(), then render as many times as you like with render().
+def render(renderer, document, *, out=None):
+    return_value = out == None
+    if return_value:
+        out = io.StringIO()
+    renderer.render(document, out)
+    if return_value:
+        return out.getvalue()
+
+# The document tree.
+# Block nodes are in Document.blocks.
+# Inline content is a list of str and inline nodes.
+# Minor inline content is a list of str and Code.
+class Document:
+    __slots__ = ("blocks", "toc_entries", "anchors", "internal_links")
+    def __init__(self, blocks, toc_entries, anchors, internal_links):
+        self.blocks = blocks
+        # List of TocEntry.
+        self.toc_entries = toc_entries
+        # Set of slugs that can be linked to.
+        self.anchors = anchors
+        # Set of slugs that internal links point to. Not necessarily a subset of anchors.
+        self.internal_links = internal_links
+    def broken_links(self):
+        return sorted(slug for slug in self.internal_links if slug not in self.anchors)
+
+class TocEntry:
+    __slots__ = ("level", "children", "slug")
+    def __init__(self, level, children, slug):
+        self.level, self.children, self.slug = level, children, slug
+# Block nodes
+class TableOfContents:
+    # Goes right before the first heading that isn't a # h1.
+    __slots__ = ()
+class Heading:
+    __slots__ = ("level", "children", "slug")
+    def __init__(self, level, children, slug):
+        self.level, self.children, self.slug = level, children, slug
+class CodeBlock:
+    __slots__ = ("language", "body")
+    def __init__(self, language, body):
+        self.language, self.body = language, body
+class List:
+    # For ordered lists, number is the item's number, and its children include the "1. " prefix.
+    # For unordered lists, number is None, and the "* " prefix is not included.
+    __slots__ = ("ordered", "items")
+    def __init__(self, ordered, items):
+        self.ordered, self.items = ordered, items
+class ListItem:
+    __slots__ = ("number", "children")
+    def __init__(self, number, children):
+        self.number, self.children = number, children
+class Paragraph:
+    # Each line is a list of inline content.
+    __slots__ = ("lines",)
+    def __init__(self, lines):
+        self.lines = lines
+# Inline nodes
+class Code:
+    __slots__ = ("text",)
+    def __init__(self, text):
+        self.text = text
+class Bold:
+    __slots__ = ("children", "slug")
+    def __init__(self, children, slug):
+        self.children, self.slug = children, slug
+class Italics:
+    __slots__ = ("children",)
+    def __init__(self, children):
+        self.children = children
+class ExternalLink:
+    __slots__ = ("url",)
+    def __init__(self, url):
+        self.url = url
+class InternalLink:
+    __slots__ = ("children", "slug")
+    def __init__(self, children, slug):
+        self.children, self.slug = children, slug
+
+def parse_markdown(contents):
+    anchor_scan = scan_anchors(contents)
+    return parse_scanned_markdown(contents, anchor_scan, InternalLinkMatcher(anchor_scan.texts))
+
+class AnchorScan:
+    __slots__ = ("counts", "toc_entries", "texts")
+    def __init__(self, counts, toc_entries, texts):
+        # Counter of slugs.
+        self.counts = counts
+        # List of TocEntry.
+        self.toc_entries = toc_entries
+        # The text of every heading and bold, which is what becomes an internal link when it shows up elsewhere.
+        self.texts = texts
+
+def scan_anchors(contents):
     # Preview to collect the set of all anchors that exist.
     internal_anchors = Counter()
-    toc_levels_and_texts = [
-        # e.g: (4, "`InfoZipUnicodePath` (`0x7075`)"),
-    ]
+    toc_entries = []
     text_of_all_anchors = []
     for match in definition_re.finditer(contents):
         if match.group("heading") != None:
             hashes, text = match.group("heading_hashes"), match.group("heading_inner")
             slug = format_slug(text, add_to=internal_anchors)
-            toc_levels_and_texts.append((len(hashes), text))
+            plain, children = parse_minor_syntax(text)
+            toc_entries.append(TocEntry(len(hashes), children, format_slug(plain)))
             text_of_all_anchors.append(text)
         elif match.group("bold") != None:
             text = match.group("bold_inner")
@@ -114,98 +305,69 @@ def markdown_to_html(contents, *, do_internal_links, toc_levels):
     if duplicate_anchors:
         sys.exit("\n".join("ERROR: duplicate anchor: " + slug for slug in duplicate_anchors))
 
-    # Generate toc_html
-    out = io.StringIO()
-    def set_indentation(level):
-        return # TODO: add ul/li nesting for TOC for better screen reader support.
-    for level, text in toc_levels_and_texts:
-        if level > toc_levels: continue
-        if out.tell() == 0:
-            out.write("<ul class=custom>\n")
-        set_indentation(level)
-        plain, formatted = format_minor_syntax(text)
-        out.write("<li><span class=symbol>{}&nbsp;</span><a class=internal href=#{}>{}</a></li>\n".format(
-            "#" * level,
-            format_slug(plain),
-            formatted,
-        ))
-    if out.tell() != 0:
-        out.write("</ul>\n")
-        toc_html = "<div class=label>Contents</div>\n" + out.getvalue()
-        out = io.StringIO()
-    else:
-        toc_html = ""
-    set_indentation(1)
-
-
-    # Construct major_syntax_re including all found links.
-    text_of_all_anchors.sort(key=lambda s: len(s), reverse=True)
-    major_syntax_re = re.compile(major_syntax_re_template % "|".join(re.escape(text) for text in text_of_all_anchors))
+    return AnchorScan(internal_anchors, toc_entries, text_of_all_anchors)
 
+# internal_link_matcher is usually for the anchors in anchor_scan, but can include the anchors of other documents too.
+def parse_scanned_markdown(contents, anchor_scan, internal_link_matcher):
+    internal_anchors = anchor_scan.counts
     internal_anchors_again = Counter() # asserted same as internal_anchors
     internal_links = set()
+    blocks = []
 
-    currently_in_paragraph = False
-    def ensure_paragraph():
-        nonlocal currently_in_paragraph
-        if not currently_in_paragraph:
-            out.write("<p>\n")
-            currently_in_paragraph = True
+    paragraph_lines = None
     def flush_paragraph():
-        nonlocal currently_in_paragraph
-        if currently_in_paragraph:
-            out.write("</p>\n")
-            currently_in_paragraph = False
-
-    def write_major_syntax(text):
+        nonlocal paragraph_lines
+        if paragraph_lines != None:
+            blocks.append(Paragraph(paragraph_lines))
+            paragraph_lines = None
+
+    def parse_major_syntax(text, pos=0):
+        # Everything is done with offsets into text rather than slicing off the rest of it after every token,
+        # so this is linear in the length of the text.
+        children = []
+        match = major_syntax_re.search(text, pos)
         while True:
-            match = major_syntax_re.search(text)
+            link_span = internal_link_matcher.search(text, pos, len(text) if match == None else match.start())
+            if link_span != None and (match == None or link_span[0] < match.start() or match.group("code") != None):
+                # An internal link comes first, or it's tied with `code`, which has lower precedence.
+                start, end = link_span
+                if start > pos:
+                    children.append(text[pos:start])
+                plain, link_children = parse_minor_syntax(text, start, end)
+                children.append(InternalLink(link_children, format_slug(plain, add_to=internal_links)))
+                pos = end
+                if match != None and match.start() < pos:
+                    # The link overlapped the match we were holding on to.
+                    match = major_syntax_re.search(text, pos)
+                continue
+
             if match == None:
-                out.write(escape_text(text))
-                return
-            out.write(escape_text(text[:match.span()[0]]))
+                if len(text) > pos:
+                    children.append(text[pos:])
+                return children
+            if match.start() > pos:
+                children.append(text[pos:match.start()])
 
             if match.group("external_link"):
-                out.write("<a class=external href={}>{}</a>".format(
-                    escape_attribute(match.group()),
-                    escape_text(match.group()),
-                ))
+                children.append(ExternalLink(match.group()))
             elif match.group("bold"):
-                plain, formatted = format_minor_syntax(match.group("bold_inner"))
-                slug = format_slug(plain, add_to=internal_anchors_again)
-                out.write("<strong id={}>{}{}{}</strong>".format(
-                    slug,
-                    "<a class=self-link href=#{}><span class=symbol>**</span></a>".format(slug),
-                    formatted,
-                    "<span class=symbol>**</span>",
-                ))
+                plain, bold_children = parse_minor_syntax(text, *match.span("bold_inner"))
+                children.append(Bold(bold_children, format_slug(plain, add_to=internal_anchors_again)))
             elif match.group("italics"):
-                plain, formatted = format_minor_syntax(match.group("italics_inner"))
-                out.write("<span class=symbol>_</span><em>{}</em><span class=symbol>_</span>".format(formatted))
-            elif match.group("internal_link"):
-                plain, formatted = format_minor_syntax(match.group())
-                if do_internal_links:
-                    out.write("<a class=internal href=#{}>{}</a>".format(
-                        format_slug(plain, add_to=internal_links),
-                        formatted,
-                    ))
-                else:
-                    out.write(formatted)
+                plain, italics_children = parse_minor_syntax(text, *match.span("italics_inner"))
+                children.append(Italics(italics_children))
             elif match.group("code"):
-                out.write("{}<code>{}</code>{}".format(
-                    "<span class=symbol>`</span>",
-                    escape_text(match.group("code_inner")),
-                    "<span class=symbol>`</span>",
-                ))
+                children.append(Code(match.group("code_inner")))
             else: assert False, match.group()
 
-            text = text[match.span()[1]:]
+            pos = match.end()
+            match = major_syntax_re.search(text, pos)
 
     found_first_non_h1_heading = False
 
     for structure in structural_re.finditer(contents):
         if structure.group("heading") != None:
-            assert not currently_in_paragraph, "Need a blank line before a # heading: " + repr(structure.group())
+            assert paragraph_lines == None, "Need a blank line before a # heading: " + repr(structure.group())
             newlines = structure.group("heading_newlines")
             assert len(newlines) == 2, "Need exactly one blank line after # heading" + repr(structure.group())
             hashes, text = structure.group("heading_hashes"), structure.group("heading_inner")
@@ -214,63 +376,47 @@ def markdown_to_html(contents, *, do_internal_links, toc_levels):
 
             if h_number > 1 and not found_first_non_h1_heading:
                 found_first_non_h1_heading = True
-                if toc_html:
-                    out.write("<div id=toc class=no-print>\n" + toc_html + "\n</div>\n")
-
-            plain, formatted = format_minor_syntax(text)
-            if h_number > 1:
-                out.write("<br class=firefox-only>")
-            slug = format_slug(plain, add_to=internal_anchors_again)
-            out.write("<h{} id={}><a class=self-link href=#{}><span class=symbol>{}</span></a> {}</h{}>".format(
-                h_number,
-                slug,
-                slug,
-                hashes,
-                formatted,
-                h_number,
-            ))
-            out.write("<br class=chrome-only>")
+                blocks.append(TableOfContents())
+
+            plain, children = parse_minor_syntax(text)
+            blocks.append(Heading(h_number, children, format_slug(plain, add_to=internal_anchors_again)))
 
         elif structure.group("code_block") != None:
-            language = structure.group("code_block_language")
-            assert not language, "TODO: code block syntax highlighting"
+            language = structure.group("code_block_language").strip()
+            if language and language not in syntax_highlighters:
+                sys.exit("ERROR: no syntax highlighting for code block language {}. Known languages: {}".format(
+                    repr(language), ", ".join(sorted(syntax_highlighters.keys())),
+                ))
             flush_paragraph()
-            out.write("<pre><span class=symbol>```</span>\n")
-            out.write(escape_text(structure.group("code_block_body")))
-            out.write("<span class=symbol>```</span></pre>")
+            blocks.append(CodeBlock(language, structure.group("code_block_body")))
 
         elif structure.group("unordered_list") != None:
             flush_paragraph()
             lines = structure.group().rstrip().split("\n")
-            out.write("<ul class=custom>\n")
-            for line in lines:
-                line = line.split(" ", 1)[1]
-                out.write("<li class=custom><span class=symbol>*</span> ")
-                write_major_syntax(line)
-                out.write("</li>\n")
-            out.write("</ul>\n")
+            blocks.append(List(False, [
+                ListItem(None, parse_major_syntax(line, line.index(" ") + 1))
+                for line in lines
+            ]))
 
         elif structure.group("ordered_list") != None:
             flush_paragraph()
             lines = structure.group().rstrip().split("\n")
-            out.write("<ol class=custom>\n")
+            items = []
             expected_number = 1
             for line in lines:
-                out.write("<li class=custom>")
                 found_number = int(line.split(". ")[0])
                 assert found_number == expected_number, "Non-sequential ordered list: " + line
                 expected_number += 1
-                write_major_syntax(line)
-                out.write("</li>\n")
-            out.write("</ol>\n")
+                items.append(ListItem(found_number, parse_major_syntax(line)))
+            blocks.append(List(True, items))
 
         elif structure.group("other") != None:
             text = structure.group()
             if text:
                 # Regular paragraph text.
-                ensure_paragraph()
-                write_major_syntax(text)
-                out.write("\n")
+                if paragraph_lines == None:
+                    paragraph_lines = []
+                paragraph_lines.append(parse_major_syntax(text))
             else:
                 # Blank line terminates a paragraph.
                 flush_paragraph()
@@ -281,64 +427,483 @@ def markdown_to_html(contents, *, do_internal_links, toc_levels):
 
     assert internal_anchors == internal_anchors_again
 
-    broken_links = [slug for slug in internal_links if slug not in internal_anchors.keys()]
-    for slug in sorted(broken_links):
-        print("WARNING: broken link: " + slug, file=sys.stderr)
-
-    body_html = out.getvalue()
-
-    return body_html
-
-def format_minor_syntax(text):
-    plain = io.StringIO()
-    formatted = io.StringIO()
+    return Document(blocks, anchor_scan.toc_entries, set(internal_anchors.keys()), internal_links)
+
+def parse_minor_syntax(text, pos=0, endpos=None):
+    # Returns (plain, children) for text[pos:endpos].
+    if endpos == None:
+        endpos = len(text)
+    if text.find("`", pos, endpos) == -1:
+        # Nothing to parse.
+        plain = text[pos:endpos]
+        return plain, [plain]
+    plain = []
+    children = []
     while True:
-        match = minor_syntax_re.search(text)
+        match = minor_syntax_re.search(text, pos, endpos)
         if match == None:
-            plain.write(text)
-            formatted.write(escape_text(text))
+            plain.append(text[pos:endpos])
+            children.append(text[pos:endpos])
             break
-        plain.write(text[:match.span()[0]])
-        formatted.write(escape_text(text[:match.span()[0]]))
+        plain.append(text[pos:match.start()])
+        children.append(text[pos:match.start()])
 
         if match.group("code"):
             inner = match.group("code_inner")
-            plain.write(inner)
-            formatted.write("{}<code>{}</code>{}".format(
-                "<span class=symbol>`</span>",
-                escape_text(inner),
-                "<span class=symbol>`</span>",
-            ))
+            plain.append(inner)
+            children.append(Code(inner))
         else: assert False, match.group()
 
-        text = text[match.span()[1]:]
-    return plain.getvalue(), formatted.getvalue()
+        pos = match.end()
+    return "".join(plain), children
+
+class HtmlRenderer:
+    # The html for the page the document is hosted on.
+    # site_index is from markdown_to_html_batch(), for links to anchors in other documents.
+    # highlight is called like highlight_code() for code blocks with a language. Give something else to cache the results.
+    def __init__(self, *, do_internal_links, toc_levels, site_index=None, highlight=None):
+        assert toc_levels in allowed_toc_levels, repr((toc_levels, allowed_toc_levels))
+        self.do_internal_links = do_internal_links
+        self.toc_levels = toc_levels
+        self.site_index = site_index
+        self.highlight = highlight_code if highlight == None else highlight
+
+    def render(self, document, out):
+        self.document = document
+        self.out = out
+        for block in document.blocks:
+            self.render_block(block)
+        if self.do_internal_links and self.site_index == None:
+            for slug in document.broken_links():
+                print("WARNING: broken link: " + slug, file=sys.stderr)
+
+    def get_link_url(self, slug):
+        # Returns the url of the document that has the anchor, or None if it's this one.
+        if self.site_index == None or slug in self.document.anchors: return None
+        return self.site_index.urls.get(slug)
+
+    def render_block(self, block):
+        if type(block) == Paragraph:
+            self.out.write("<p>\n")
+            for line in block.lines:
+                self.render_inline(line)
+                self.out.write("\n")
+            self.out.write("</p>\n")
+        elif type(block) == Heading:
+            self.render_heading(block)
+        elif type(block) == List:
+            self.render_list(block)
+        elif type(block) == CodeBlock:
+            self.render_code_block(block)
+        elif type(block) == TableOfContents:
+            self.render_toc()
+        else: assert False, block
+
+    def render_heading(self, heading):
+        if heading.level > 1:
+            self.out.write("<br class=firefox-only>")
+        self.out.write("<h{} id={}><a class=self-link href=#{}><span class=symbol>{}</span></a> ".format(
+            heading.level,
+            heading.slug,
+            heading.slug,
+            "#" * heading.level,
+        ))
+        self.render_inline(heading.children)
+        self.out.write("</h{}>".format(heading.level))
+        self.out.write("<br class=chrome-only>")
+
+    def render_list(self, list_node):
+        if list_node.ordered:
+            self.out.write("<ol class=custom>\n")
+            for item in list_node.items:
+                self.out.write("<li class=custom>")
+                self.render_inline(item.children)
+                self.out.write("</li>\n")
+            self.out.write("</ol>\n")
+        else:
+            self.out.write("<ul class=custom>\n")
+            for item in list_node.items:
+                self.out.write("<li class=custom><span class=symbol>*</span> ")
+                self.render_inline(item.children)
+                self.out.write("</li>\n")
+            self.out.write("</ul>\n")
+
+    def render_code_block(self, code_block):
+        self.out.write("<pre><span class=symbol>```{}</span>\n".format(escape_text(code_block.language)))
+        if code_block.language:
+            self.out.write(self.highlight(code_block.language, code_block.body))
+        else:
+            self.out.write(escape_text(code_block.body))
+        self.out.write("<span class=symbol>```</span></pre>")
+
+    def render_toc(self):
+        def set_indentation(level):
+            return # TODO: add ul/li nesting for TOC for better screen reader support.
+        entries = [entry for entry in self.document.toc_entries if entry.level <= self.toc_levels]
+        if not entries: return
+        self.out.write("<div id=toc class=no-print>\n<div class=label>Contents</div>\n<ul class=custom>\n")
+        for entry in entries:
+            set_indentation(entry.level)
+            self.out.write("<li><span class=symbol>{}&nbsp;</span><a class=internal href=#{}>".format(
+                "#" * entry.level,
+                entry.slug,
+            ))
+            self.render_inline(entry.children)
+            self.out.write("</a></li>\n")
+        set_indentation(1)
+        self.out.write("</ul>\n\n</div>\n")
+
+    def render_inline(self, children):
+        for child in children:
+            if type(child) == str:
+                self.out.write(escape_text(child))
+            elif type(child) == Code:
+                self.render_code(child)
+            elif type(child) == InternalLink:
+                self.render_internal_link(child)
+            elif type(child) == ExternalLink:
+                self.render_external_link(child)
+            elif type(child) == Bold:
+                self.render_bold(child)
+            elif type(child) == Italics:
+                self.render_italics(child)
+            else: assert False, child
+
+    def render_code(self, code):
+        self.out.write("{}<code>{}</code>{}".format(
+            "<span class=symbol>`</span>",
+            escape_text(code.text),
+            "<span class=symbol>`</span>",
+        ))
 
-attribute_substitutions = {
-    # https://www.w3.org/TR/2012/WD-html-markup-20120329/syntax.html#syntax-attr-unquoted
-    '"': "&quot;",
-    "'": "&apos;",
-    "=": "&#61;",
-    ">": "&gt;",
-    "<": "&lt;",
-    "`": "&#96;",
-    "&": "&amp;",
-}
-attribute_escape_re = re.compile(r'[{}]'.format(r''.join(attribute_substitutions.keys())))
+    def render_external_link(self, link):
+        self.out.write("<a class=external href={}>{}</a>".format(
+            escape_attribute(link.url),
+            escape_text(link.url),
+        ))
+
+    def render_internal_link(self, link):
+        if self.do_internal_links:
+            self.out.write("<a class=internal href={}>".format(escape_attribute((self.get_link_url(link.slug) or "") + "#" + link.slug)))
+            self.render_inline(link.children)
+            self.out.write("</a>")
+        else:
+            self.render_inline(link.children)
+
+    def render_bold(self, bold):
+        self.out.write("<strong id={}><a class=self-link href=#{}><span class=symbol>**</span></a>".format(bold.slug, bold.slug))
+        self.render_inline(bold.children)
+        self.out.write("<span class=symbol>**</span></strong>")
+
+    def render_italics(self, italics):
+        self.out.write("<span class=symbol>_</span><em>")
+        self.render_inline(italics.children)
+        self.out.write("</em><span class=symbol>_</span>")
+
+class FeedHtmlRenderer(HtmlRenderer):
+    # Html that makes sense out of context, such as in an rss reader.
+    # Feed readers drop our stylesheet, so leave out the markdown symbols that would otherwise be hidden or grayed out.
+    def __init__(self, *, do_internal_links, base_url, site_index=None):
+        super().__init__(do_internal_links=do_internal_links, toc_levels=0, site_index=site_index)
+        self.base_url = base_url
+
+    def render(self, document, out):
+        self.document = document
+        self.out = out
+        for block in document.blocks:
+            self.render_block(block)
+
+    def render_heading(self, heading):
+        self.out.write("<h{}>".format(heading.level))
+        self.render_inline(heading.children)
+        self.out.write("</h{}>\n".format(heading.level))
+
+    def render_list(self, list_node):
+        tag = "ol" if list_node.ordered else "ul"
+        self.out.write("<{}>\n".format(tag))
+        for item in list_node.items:
+            children = item.children
+            if item.number != None:
+                # The <ol> does the numbering.
+                prefix = "{}. ".format(item.number)
+                if children and type(children[0]) == str and children[0].startswith(prefix):
+                    children = [children[0][len(prefix):]] + children[1:]
+            self.out.write("<li>")
+            self.render_inline(children)
+            self.out.write("</li>\n")
+        self.out.write("</{}>\n".format(tag))
+
+    def render_code_block(self, code_block):
+        self.out.write("<pre>")
+        self.out.write(escape_text(code_block.body))
+        self.out.write("</pre>\n")
+
+    def render_toc(self):
+        pass
+
+    def render_code(self, code):
+        self.out.write("<code>{}</code>".format(escape_text(code.text)))
+
+    def render_external_link(self, link):
+        self.out.write("<a href={}>{}</a>".format(
+            escape_attribute(link.url),
+            escape_text(link.url),
+        ))
+
+    def render_internal_link(self, link):
+        if self.do_internal_links:
+            url = self.get_link_url(link.slug)
+            url = self.base_url if url == None else urllib.parse.urljoin(self.base_url, url)
+            self.out.write("<a href={}>".format(escape_attribute(url + "#" + link.slug)))
+            self.render_inline(link.children)
+            self.out.write("</a>")
+        else:
+            self.render_inline(link.children)
+
+    def render_bold(self, bold):
+        self.out.write("<strong>")
+        self.render_inline(bold.children)
+        self.out.write("</strong>")
+
+    def render_italics(self, italics):
+        self.out.write("<em>")
+        self.render_inline(italics.children)
+        self.out.write("</em>")
+
+class PlainTextRenderer:
+    # Just the words, for search indexes and summaries.
+    def render(self, document, out):
+        self.out = out
+        for block in document.blocks:
+            if type(block) == Paragraph:
+                for line in block.lines:
+                    self.render_inline(line)
+                    self.out.write("\n")
+                self.out.write("\n")
+            elif type(block) == Heading:
+                self.render_inline(block.children)
+                self.out.write("\n\n")
+            elif type(block) == List:
+                for item in block.items:
+                    if item.number == None:
+                        self.out.write("* ")
+                    self.render_inline(item.children)
+                    self.out.write("\n")
+                self.out.write("\n")
+            elif type(block) == CodeBlock:
+                self.out.write(block.body)
+                self.out.write("\n")
+            elif type(block) == TableOfContents:
+                pass
+            else: assert False, block
+
+    def render_inline(self, children):
+        for child in children:
+            if type(child) == str:
+                self.out.write(child)
+            elif type(child) == Code:
+                self.out.write(child.text)
+            elif type(child) == ExternalLink:
+                self.out.write(child.url)
+            elif type(child) in (InternalLink, Bold, Italics):
+                self.render_inline(child.children)
+            else: assert False, child
+
+word_char_re = re.compile(r'\w')
+class InternalLinkMatcher:
+    # Finds the same matches as this regex would:
+    #   r'(?<!\w)(?:Endnote `Something`|`MyStruct`|...)(?!\w)'
+    # with the alternatives sorted longest first,
+    # but with a trie instead of a giant alternation,
+    # so the cost doesn't scale with the number of anchors.
+    def __init__(self, texts):
+        # Each node is a dict of char -> child node. The None key marks the end of a text.
+        self.trie = {}
+        for text in texts:
+            node = self.trie
+            for c in text:
+                node = node.setdefault(c, {})
+            node[None] = True
+        # Skip to plausible starting positions with the regex engine rather than stepping through every char in Python.
+        if self.trie:
+            self.start_re = re.compile(r'(?<!\w)[{}]'.format("".join(re.escape(c) for c in self.trie.keys())))
+        else:
+            self.start_re = None
+
+    def search(self, text, pos, endpos):
+        # Returns (start, end) of the first match starting in text[pos:endpos+1], or None.
+        # Like searching text[pos:], the char before pos does not count as a preceding \w.
+        if self.start_re == None: return None
+        end = self.match_at(text, pos)
+        if end != None: return pos, end
+        start_match = self.start_re.search(text, pos + 1, endpos + 1)
+        while start_match != None:
+            start = start_match.start()
+            end = self.match_at(text, start)
+            if end != None: return start, end
+            start_match = self.start_re.search(text, start + 1, endpos + 1)
+        return None
+
+    def match_at(self, text, start):
+        # Returns the end of the longest text that matches at start followed by a non-\w, or None.
+        longest_end = None
+        node = self.trie
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node == None: break
+            if None in node and word_char_re.match(text, i + 1) == None:
+                longest_end = i + 1
+        return longest_end
+
+# These run on every bit of text in the document, so they're written for speed rather than as a table of substitutions.
+# Most text has nothing to escape, and checking for that is much cheaper than calling re.sub() or str.translate().
+# Otherwise, a chain of str.replace() is still faster than either of those.
+# "&" has to go first, so that it doesn't escape the other escapes.
 def escape_attribute(text):
-    return attribute_escape_re.sub((lambda m: attribute_substitutions[m.group()]), text)
-text_substitutions = {
-    ">": "&gt;",
-    "<": "&lt;",
-    "&": "&amp;",
-}
-text_escape_re = re.compile(r'[{}]'.format(r''.join(text_substitutions.keys())))
+    # https://www.w3.org/TR/2012/WD-html-markup-20120329/syntax.html#syntax-attr-unquoted
+    return (text
+        .replace("&", "&amp;")
+        .replace('"', "&quot;")
+        .replace("'", "&apos;")
+        .replace("=", "&#61;")
+        .replace(">", "&gt;")
+        .replace("<", "&lt;")
+        .replace("`", "&#96;")
+    )
 def escape_text(text):
-    return text_escape_re.sub((lambda m: text_substitutions[m.group()]), text)
+    if "&" not in text and "<" not in text and ">" not in text:
+        return text
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+def escape_texts(fragments):
+    # Same as [escape_text(fragment) for fragment in fragments], without a function call per fragment.
+    return [
+        fragment.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        if "&" in fragment or "<" in fragment or ">" in fragment else fragment
+        for fragment in fragments
+    ]
 
 def escape_cdata(text):
     return text.replace("]]>", "]]]]><![CDATA[>")
 
+# Build-time syntax highlighting. The output is <span class=syntax-keyword> etc. for the stylesheet to color.
+# Only HtmlRenderer highlights. The other renderers output code blocks as plain text.
+def highlight_code(language, code):
+    pieces = []
+    for token_class, text in syntax_highlighters[language].tokenize(code):
+        if token_class == None:
+            pieces.append(escape_text(text))
+        else:
+            pieces.append("<span class=syntax-{}>{}</span>".format(token_class, escape_text(text)))
+    return "".join(pieces)
+
+class RegexTokenizer:
+    # rules is a list of (token_class, regex) where the regex has no capturing groups.
+    # At each position, the first rule that matches wins, and text that no rule matches is plain.
+    def __init__(self, rules):
+        self.rules = rules
+        self.token_re = re.compile("|".join("(?P<rule{}>{})".format(i, regex) for i, (token_class, regex) in enumerate(rules)), re.MULTILINE)
+        self.token_classes = {"rule{}".format(i): token_class for i, (token_class, regex) in enumerate(rules)}
+
+    def tokenize(self, code):
+        # Returns a list of (token_class, text) that add up to code. token_class is None for plain text.
+        tokens = []
+        pos = 0
+        for match in self.token_re.finditer(code):
+            if match.start() == match.end(): continue
+            if match.start() > pos:
+                tokens.append((None, code[pos:match.start()]))
+            tokens.append((self.token_classes[match.lastgroup], match.group()))
+            pos = match.end()
+        if pos < len(code):
+            tokens.append((None, code[pos:]))
+        return tokens
+
+def keywords_regex(keywords):
+    return r'\b(?:{})\b'.format("|".join(keywords.split()))
+c_like_comment_regex = r'//[^\n]*|/\*[\s\S]*?\*/'
+double_quoted_string_regex = r'"(?:\\.|[^"\\\n])*"'
+single_quoted_string_regex = r"'(?:\\.|[^'\\\n])*'"
+number_regex = r'\b(?:0[xX][0-9a-fA-F_]+|0[bB][01_]+|0[oO][0-7_]+|[0-9][0-9_]*(?:\.[0-9_]+)?(?:[eE][+-]?[0-9]+)?)\b'
+
+python_tokenizer = RegexTokenizer([
+    ("comment", r'#[^\n]*'),
+    ("string", r'(?<!\w)[rRbBuUfF]{0,2}(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|' + double_quoted_string_regex + "|" + single_quoted_string_regex + ")"),
+    ("keyword", keywords_regex(
+        "False None True and as assert async await break class continue def del elif else except finally for from "
+        "global if import in is lambda nonlocal not or pass raise return try while with yield"
+    )),
+    ("builtin", keywords_regex("print len range str int float list dict set tuple bytes open isinstance type super self")),
+    ("number", number_regex),
+])
+javascript_tokenizer = RegexTokenizer([
+    ("comment", c_like_comment_regex),
+    ("string", double_quoted_string_regex + "|" + single_quoted_string_regex + r'|`(?:\\.|[^`\\])*`'),
+    ("keyword", keywords_regex(
+        "async await break case catch class const continue debugger default delete do else export extends false finally "
+        "for function if import in instanceof let new null of return static super switch this throw true try typeof "
+        "undefined var void while with yield"
+    )),
+    ("number", number_regex),
+])
+c_tokenizer = RegexTokenizer([
+    ("comment", c_like_comment_regex),
+    ("keyword", r'^[ \t]*#[ \t]*\w+'),
+    ("string", double_quoted_string_regex + "|" + single_quoted_string_regex),
+    ("keyword", keywords_regex(
+        "auto break case char const continue default do double else enum extern float for goto if inline int long "
+        "register restrict return short signed sizeof static struct switch typedef union unsigned void volatile while "
+        "bool true false NULL size_t uint8_t uint16_t uint32_t uint64_t int8_t int16_t int32_t int64_t"
+    )),
+    ("number", number_regex),
+])
+zig_tokenizer = RegexTokenizer([
+    ("comment", r'//[^\n]*'),
+    ("string", double_quoted_string_regex + "|" + single_quoted_string_regex + r'|\\\\[^\n]*'),
+    ("builtin", r'@\w+'),
+    ("keyword", keywords_regex(
+        "addrspace align allowzero and anyframe anytype asm async await break callconv catch comptime const continue "
+        "defer else enum errdefer error export extern fn for if inline linksection noalias noinline nosuspend opaque "
+        "or orelse packed pub resume return struct suspend switch test threadlocal try union unreachable usingnamespace "
+        "var volatile while true false null undefined"
+    )),
+    ("number", number_regex),
+])
+shell_tokenizer = RegexTokenizer([
+    ("comment", r'(?<![\w$])#[^\n]*'),
+    ("string", r'"(?:\\.|[^"\\])*"|\'[^\']*\''),
+    ("variable", r'\$(?:\{[^}\n]*\}|\w+|[@*#?$!0-9-])'),
+    ("keyword", keywords_regex("if then else elif fi for while until do done case esac in function return local export set")),
+])
+json_tokenizer = RegexTokenizer([
+    ("string", double_quoted_string_regex),
+    ("keyword", keywords_regex("true false null")),
+    ("number", r'-?' + number_regex),
+])
+# The language after ``` -> a tokenizer, which is anything with a tokenize() like RegexTokenizer.
+syntax_highlighters = {
+    "python": python_tokenizer,
+    "py": python_tokenizer,
+    "javascript": javascript_tokenizer,
+    "js": javascript_tokenizer,
+    "c": c_tokenizer,
+    "zig": zig_tokenizer,
+    "sh": shell_tokenizer,
+    "bash": shell_tokenizer,
+    "shell": shell_tokenizer,
+    "json": json_tokenizer,
+}
+def register_syntax_highlighter(language, tokenizer):
+    syntax_highlighters[language] = tokenizer
+
+# Changes whenever the output of highlight_code() might change, for caching it.
+# Bump the number for changes to highlight_code() itself. Changes to the rules are noticed automatically.
+syntax_highlighting_markup_version = 1
+def get_syntax_highlighter_version():
+    return hashlib.sha256(repr((
+        syntax_highlighting_markup_version,
+        sorted((language, getattr(tokenizer, "rules", type(tokenizer).__qualname__)) for language, tokenizer in syntax_highlighters.items()),
+    )).encode("utf8")).hexdigest()
+
 non_slug_text_re = re.compile(r'[^A-Za-z0-9]+')
 def format_slug(text, add_to=None):
     slug = non_slug_text_re.sub("-", text).removeprefix("-").removesuffix("-")
@@ -0,0 +1,107 @@
+(function() {
+  // The index is generated by build.py. See generate_search_index() there for the format.
+  var searchIndexUrl = "/blog/search/";
+  var searchBox = document.getElementById("search");
+  var resultsList = document.getElementById("search-results");
+  var fetchCache = {};
+  var latestQuery = null;
+
+  searchBox.addEventListener("input", function() {
+    var query = searchBox.value;
+    latestQuery = query;
+    search(query).then(function(results) {
+      // Ignore slow responses for something the user has already typed past.
+      if (query !== latestQuery) return;
+      renderResults(results);
+    });
+  });
+
+  function search(query) {
+    // Close enough to python's \w, which is what build.py splits words on.
+    var terms = query.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+    if (terms.length === 0) return Promise.resolve([]);
+    var requests = [fetchJson("posts.json")].concat(terms.map(function(term) {
+      return fetchJson(getShardName(term) + ".json");
+    }));
+    return Promise.all(requests).then(function(responses) {
+      var documents = responses[0];
+      // positionsById[id][i] is the positions of terms[i] in that post.
+      var positionsById = {};
+      terms.forEach(function(term, i) {
+        var shard = responses[i + 1];
+        // Not shard[term], which finds things like "constructor" on every object.
+        var postings = Object.prototype.hasOwnProperty.call(shard, term) ? shard[term] : [];
+        postings.forEach(function(posting) {
+          var id = posting[0];
+          if (i === 0) positionsById[id] = [];
+          if (positionsById[id] == null || positionsById[id].length !== i) return;
+          positionsById[id].push(posting.slice(1));
+        });
+      });
+      var results = [];
+      for (var id in positionsById) {
+        var positions = positionsById[id];
+        // Every term has to be in the post.
+        if (positions.length !== terms.length) continue;
+        results.push({
+          path: documents[id][0],
+          title: documents[id][1],
+          id: parseInt(id, 10),
+          score: scorePost(positions),
+        });
+      }
+      results.sort(function(a, b) {
+        // Newer posts have higher ids.
+        return (b.score - a.score) || (b.id - a.id);
+      });
+      return results;
+    });
+  }
+
+  function scorePost(positions) {
+    var score = 0;
+    positions.forEach(function(termPositions) {
+      score += termPositions.length;
+    });
+    // The words next to each other in the same order counts for a lot more.
+    positions[0].forEach(function(start) {
+      for (var i = 1; i < positions.length; i++) {
+        if (positions[i].indexOf(start + i) === -1) return;
+      }
+      score += 10;
+    });
+    return score;
+  }
+
+  function getShardName(term) {
+    var prefix = Array.from(term).slice(0, 2);
+    if (/^[a-z0-9_]+$/.test(prefix.join(""))) return prefix.join("");
+    // Same as get_search_shard() in build.py.
+    return "u" + prefix.map(function(c) {
+      return c.codePointAt(0).toString(16);
+    }).join("-");
+  }
+
+  function fetchJson(name) {
+    if (fetchCache[name] == null) {
+      fetchCache[name] = fetch(searchIndexUrl + name).then(function(response) {
+        // No shard means no post has any words starting with those letters.
+        if (!response.ok) return {};
+        return response.json();
+      });
+    }
+    return fetchCache[name];
+  }
+
+  function renderResults(results) {
+    resultsList.textContent = "";
+    results.forEach(function(result) {
+      var li = document.createElement("li");
+      var a = document.createElement("a");
+      a.setAttribute("href", "/" + result.path);
+      a.textContent = result.title;
+      li.appendChild(a);
+      resultsList.appendChild(li);
+    });
+  }
+})();